@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Compare per build step btrfs latency of the ioctl and cli backends
+
+Creates a loopback btrfs image, mounts it and repeats the subvolume
+operations of a single build step (snapshot parent, seal with a
+readonly snapshot, delete the writable one) with both backends.
+Must be run as root with btrfs-progs installed.
+
+    sudo python3 benchmarks/bench_btrfs.py --steps 200
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import noby
+
+
+def loopback_btrfs(workdir, size):
+    image = workdir / "btrfs.img"
+    mountpoint = workdir / "mnt"
+    mountpoint.mkdir()
+    with image.open("wb") as f:
+        f.truncate(size)
+    subprocess.run(("mkfs.btrfs", "-q", str(image)), check=True)
+    subprocess.run(("mount", "-o", "loop", str(image), str(mountpoint)), check=True)
+    return mountpoint
+
+
+def bench_backend(backend, root, steps):
+    noby.btrfs_backend = backend
+    root = root / backend
+    root.mkdir()
+    base = root / "base"
+    noby.btrfs_subvol_create(base)
+
+    parent = base
+    timings = []
+    for step in range(steps):
+        target = root / "step{}-init".format(step)
+        final_target = root / "step{}".format(step)
+        start = time.perf_counter()
+        noby.btrfs_subvol_snapshot(parent, target)
+        noby.btrfs_subvol_snapshot(target, final_target, readonly=True)
+        noby.btrfs_subvol_delete(target)
+        timings.append(time.perf_counter() - start)
+        parent = final_target
+
+    start = time.perf_counter()
+    noby.btrfs_subvol_delete_many(
+        [root / "step{}".format(step) for step in range(steps)] + [base], commit=True)
+    delete_all = time.perf_counter() - start
+
+    timings.sort()
+    return {
+        "steps": steps,
+        "step_mean_ms": sum(timings) / len(timings) * 1000,
+        "step_median_ms": timings[len(timings) // 2] * 1000,
+        "batched_delete_ms": delete_all * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--size', type=int, default=512 * 1024 * 1024,
+                        help="Loopback image size in bytes")
+    parser.add_argument('--output', '-o', help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    if os.getuid() != 0:
+        print("This benchmark must be run as root")
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        mountpoint = loopback_btrfs(Path(workdir), args.size)
+        try:
+            results = {backend: bench_backend(backend, mountpoint, args.steps)
+                       for backend in ("cli", "ioctl")}
+        finally:
+            subprocess.run(("umount", str(mountpoint)), check=True)
+
+    for backend, result in results.items():
+        print("{:6} step {:8.2f} ms mean {:8.2f} ms median, batched delete {:8.2f} ms".format(
+            backend, result["step_mean_ms"], result["step_median_ms"], result["batched_delete_ms"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Plain directory stand-ins for the btrfs and systemd-nspawn helpers
+
+Subvolumes become directories and snapshots become copies, RUN commands
+and RUN sessions are executed with /bin/sh on the host inside the target
+directory. This lets builds run without root, btrfs or systemd-nspawn,
+the absolute numbers are therefore only comparable against the same
+backend.
+"""
+import os
+import shutil
+import subprocess
+import contextlib
+from pathlib import Path
+
+import noby
+
+
+class FakeBackend():
+
+    def __init__(self):
+        self.counts = {"create": 0, "snapshot": 0, "delete": 0, "nspawn": 0}
+
+    def subvol_create(self, path):
+        self.counts["create"] += 1
+        os.mkdir(str(path))
+
+    def subvol_snapshot(self, src, dest, *, readonly=False):
+        self.counts["snapshot"] += 1
+        shutil.copytree(str(src), str(dest), symlinks=True)
+
+    def subvol_delete(self, path):
+        self.counts["delete"] += 1
+        shutil.rmtree(str(path))
+
+    def subvol_delete_many(self, paths, *, commit=False):
+        for path in paths:
+            self.subvol_delete(path)
+
+    def nspawn_run(self, target, command, *, env=None, options=(), **kwargs):
+        self.counts["nspawn"] += 1
+        return subprocess.run(("/bin/sh", "-c", command), cwd=str(target), env=env or {}, **kwargs)
+
+    def session_class(self):
+        backend = self
+
+        class HostSession(noby.NspawnSession):
+            def _command(self):
+                backend.counts["nspawn"] += 1
+                return ["/bin/sh"]
+        return HostSession
+
+    @contextlib.contextmanager
+    def installed(self):
+        """Swap the noby helpers for this backend while the block runs"""
+        replacements = {
+            "NspawnSession": self.session_class(),
+            "btrfs_subvol_create": self.subvol_create,
+            "btrfs_subvol_snapshot": self.subvol_snapshot,
+            "btrfs_subvol_delete": self.subvol_delete,
+            "btrfs_subvol_delete_many": self.subvol_delete_many,
+            "nspawn_run": self.nspawn_run,
+        }
+        originals = {name: getattr(noby, name) for name in replacements}
+        for name, func in replacements.items():
+            setattr(noby, name, func)
+        try:
+            yield self
+        finally:
+            for name, func in originals.items():
+                setattr(noby, name, func)
+
+
+class LoopbackBtrfsBackend(FakeBackend):
+    """Real btrfs helpers on a loopback image, RUN commands still run on the host"""
+
+    def subvol_create(self, path):
+        self.counts["create"] += 1
+        self._btrfs.btrfs_subvol_create(path)
+
+    def subvol_snapshot(self, src, dest, *, readonly=False):
+        self.counts["snapshot"] += 1
+        self._btrfs.btrfs_subvol_snapshot(src, dest, readonly=readonly)
+
+    def subvol_delete(self, path):
+        self.counts["delete"] += 1
+        self._btrfs.btrfs_subvol_delete(path)
+
+    @contextlib.contextmanager
+    def installed(self):
+        #  Keep references to the real helpers before they get replaced
+        self._btrfs = type("btrfs", (), {
+            "btrfs_subvol_create": staticmethod(noby.btrfs_subvol_create),
+            "btrfs_subvol_snapshot": staticmethod(noby.btrfs_subvol_snapshot),
+            "btrfs_subvol_delete": staticmethod(noby.btrfs_subvol_delete),
+        })
+        with super().installed():
+            yield self
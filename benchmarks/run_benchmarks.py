@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""noby benchmark suite
+
+Runs the parser, hashing, image store and build benchmarks against the
+fake directory backend (default) or a loopback btrfs image and writes
+the results as JSON so that releases can be compared.
+
+    python3 benchmarks/run_benchmarks.py -o results.json
+    python3 benchmarks/run_benchmarks.py --compare results.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import noby
+from fake_backend import FakeBackend, LoopbackBtrfsBackend
+
+
+def timed(func, repeat):
+    """Best wall time of repeat calls of func"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def quiet():
+    return contextlib.redirect_stdout(open(os.devnull, "w"))
+
+
+def write_dockerfile(path, steps, copy_src=None):
+    lines = ["FROM scratch", "ENV FOO=foo"]
+    for step in range(steps):
+        if copy_src and step % 10 == 0:
+            lines.append("COPY {} /copy{}".format(copy_src, step))
+        elif step % 3 == 0:
+            lines.append("HOST echo step {} > $TARGET/step{} \\\n    && true".format(step, step))
+        elif step % 3 == 1:
+            lines.append("# comment {}".format(step))
+            lines.append("RUN echo step {} >> log".format(step))
+        else:
+            lines.append("RUN true {}".format(step))
+    path.write_text("\n".join(lines) + "\n")
+
+
+def bench_parser(workdir, args):
+    dockerfile = workdir / "Dockerfile.large"
+    write_dockerfile(dockerfile, args.dockerfile_steps)
+    df = noby.DockerfileParser(dockerfile)
+    return {
+        "steps": len(df.build_commands),
+        "parse_seconds": timed(lambda: noby.DockerfileParser(dockerfile), args.repeat),
+        "hash_seconds": timed(lambda: df.calc_build_hashes(parent_hash="0" * 64), args.repeat),
+    }
+
+
+def bench_scan(workdir, args):
+    runtime = workdir / "scan-runtime"
+    runtime.mkdir()
+    parent = ""
+    for number in range(args.images):
+        image = "{:064x}".format(number)
+        (runtime / image).mkdir()
+        os.setxattr(str(runtime / image), b"user.parent_hash", parent.encode())
+        os.setxattr(str(runtime / image), b"user.cmd.run", b"true")
+        parent = image if number % 10 else ""
+    r = noby.ImageStorage(runtime)
+    return {
+        "images": args.images,
+        "scan_seconds": timed(r._scan, args.repeat),
+        "reindex_seconds": timed(r.reindex, args.repeat),
+        "open_seconds": timed(lambda: noby.ImageStorage(runtime), args.repeat),
+        "find_children_seconds": timed(lambda: list(r.find_children("{:064x}".format(1))), args.repeat),
+    }
+
+
+def bench_build(workdir, args, backend, **options):
+    context = workdir / "build-context-{}".format("-".join(options) or "default")
+    (context / "src").mkdir(parents=True)
+    for number in range(100):
+        (context / "src" / "file{}".format(number)).write_bytes(os.urandom(4096))
+    write_dockerfile(context / "Dockerfile", args.build_steps, copy_src="src")
+    runtime = workdir / "build-runtime-{}".format("-".join(options) or "default")
+    runtime.mkdir()
+    build_args = argparse.Namespace(
+        runtime=str(runtime), path=str(context), file="Dockerfile", tag="bench",
+        no_cache=False, rm=False, env=None, **options)
+    backend.counts = dict.fromkeys(backend.counts, 0)
+
+    with backend.installed(), quiet():
+        start = time.perf_counter()
+        noby.build(build_args)
+        cold = time.perf_counter() - start
+        counts = dict(backend.counts)
+        cached = timed(lambda: noby.build(build_args), args.repeat)
+    r = noby.ImageStorage(runtime)
+    return {
+        "steps": args.build_steps,
+        "cold_build_seconds": cold,
+        "cached_rebuild_seconds": cached,
+        "subvolume_operations": counts,
+        "layers": len(r.parents()),
+        "tag_chain_layers": len(r.reachable()),
+    }
+
+
+def bench_copy(workdir, args):
+    src = workdir / "copy-src"
+    for number in range(args.copy_files):
+        directory = src / "dir{}".format(number % 50)
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / "file{}".format(number)).write_bytes(os.urandom(args.copy_size))
+    total = args.copy_files * args.copy_size
+    counter = iter(range(args.repeat))
+
+    def copy():
+        noby.copy_tree(["copy-src/."], workdir / "copy-dest{}".format(next(counter)), cwd=workdir)
+    seconds = timed(copy, args.repeat)
+    return {
+        "files": args.copy_files,
+        "bytes": total,
+        "seconds": seconds,
+        "bytes_per_second": total / seconds,
+    }
+
+
+def compare(results, baseline):
+    print("{:40} {:>12} {:>12} {:>8}".format("metric", "baseline", "current", "ratio"))
+    for name, metrics in results["results"].items():
+        for metric, value in metrics.items():
+            old = baseline.get("results", {}).get(name, {}).get(metric)
+            if not metric.endswith("seconds") or old is None:
+                continue
+            print("{:40} {:>12.6f} {:>12.6f} {:>7.2f}x".format(
+                name + "." + metric, old, value, value / old if old else float("inf")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="noby benchmark suite")
+    parser.add_argument('--backend', choices=('fake', 'btrfs'), default='fake',
+                        help="fake directories or a loopback btrfs image (needs root)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dockerfile-steps', type=int, default=10000)
+    parser.add_argument('--images', type=int, default=10000)
+    parser.add_argument('--build-steps', type=int, default=30)
+    parser.add_argument('--copy-files', type=int, default=2000)
+    parser.add_argument('--copy-size', type=int, default=64 * 1024)
+    parser.add_argument('--output', '-o', help="Write JSON results to this file")
+    parser.add_argument('--compare', help="Compare against earlier JSON results")
+    args = parser.parse_args()
+
+    results = {
+        "noby_version": noby.__version__,
+        "python": platform.python_version(),
+        "backend": args.backend,
+        "timestamp": time.time(),
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        backend = FakeBackend()
+        if args.backend == "btrfs":
+            from bench_btrfs import loopback_btrfs
+            mountpoint = loopback_btrfs(workdir, 2 * 1024 ** 3)
+            workdir, backend = mountpoint, LoopbackBtrfsBackend()
+        try:
+            for name, bench in (("parser", bench_parser), ("scan", bench_scan),
+                                ("build", lambda w, a: bench_build(w, a, backend)),
+                                ("build_run_session", lambda w, a: bench_build(w, a, backend, run_session=True)),
+                                ("build_coalesce", lambda w, a: bench_build(w, a, backend, coalesce=True)),
+                                ("build_squash", lambda w, a: bench_build(w, a, backend, coalesce=True, squash=True)),
+                                ("copy", bench_copy)):
+                print("==> Running {} benchmark".format(name))
+                results["results"][name] = bench(workdir, args)
+        finally:
+            if args.backend == "btrfs":
+                subprocess.run(("umount", str(workdir)), check=True)
+
+    print(json.dumps(results["results"], indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,76 @@
 #!/usr/bin/env python3
 import os
+import re
+import array
 import sys
+import ctypes
+import select
+import errno
+import fcntl
+import stat
+import struct
 import shlex
+import socket
+import socketserver
+import traceback
 import shutil
+import heapq
+import queue
+import json
+import time
+import sqlite3
+import threading
 import argparse
+import contextlib
+import functools
 import subprocess
+import concurrent.futures
 import distutils.util
 from hashlib import sha256
 from pathlib import Path
+from urllib.request import pathname2url
 from pprint import pprint
 
 
 __version__ = "0.6"
 nspawn_cmd_base = ['systemd-nspawn', '--quiet']
+metadata_db_name = ".noby.db"
+export_cache_name = ".export-cache"
+env_reference_re = re.compile(r"\$(?:\{([A-Za-z_][A-Za-z0-9_]*)[^}]*\}|([A-Za-z_][A-Za-z0-9_]*))")
+
+
+class BuildStage():
+    """One FROM section of a Dockerfile with its own hash chain"""
+
+    def __init__(self, index, from_image, name=None):
+        self.index = index
+        self.from_image = from_image
+        self.name = name
+        self.parent_hash = ""
+        self.build_commands = []
+        self.build_hashes = []
+
+    @property
+    def label(self):
+        return self.name if self.name else str(self.index)
+
+    @property
+    def image_hash(self):
+        """Hash of the image this stage produces"""
+        return self.build_hashes[-1] if self.build_hashes else self.parent_hash
+
+
+def parse_copy_args(args):
+    """Split COPY arguments into (from_stage, srcs, dest)"""
+    from_stage = None
+    *srcs, dest = shlex.split(args)
+    while srcs and srcs[0].startswith("--"):
+        option = srcs.pop(0)
+        if option.startswith("--from="):
+            from_stage = option[len("--from="):]
+        else:
+            raise ValueError("Unknown COPY option {}".format(option))
+    return from_stage, srcs, dest
 
 
 class DockerfileParser():
@@ -20,11 +78,24 @@ class DockerfileParser():
     def __init__(self, dockerfile):
         self.lines = []
         self.env = {}
-        self.from_image = None
-        self.build_commands = []
-        self.build_hashes = []
+        self.stages = []
+        self.base_hashes = {}
+        self.parent_hash = ""
         self._parse_file(dockerfile)
 
+    #  The final stage is the image that gets built and tagged
+    @property
+    def from_image(self):
+        return self.stages[-1].from_image if self.stages else None
+
+    @property
+    def build_commands(self):
+        return self.stages[-1].build_commands if self.stages else []
+
+    @property
+    def build_hashes(self):
+        return self.stages[-1].build_hashes if self.stages else []
+
     def _populate_env(self, rawenv):
         env_name, *value = rawenv.split("=")  # replace with shlex maybe
         self.env[env_name] = "=".join(value)
@@ -37,10 +108,66 @@ class DockerfileParser():
             self._populate_env(args)
 
         elif cmd in ("host", "run", "copy"):
-            self.build_commands.append((cmd, args))
+            if not self.stages:
+                self.stages.append(BuildStage(0, None))
+            self.stages[-1].build_commands.append((cmd, args))
 
         elif cmd == "from":
-            self.from_image = args
+            image, *alias = args.split()
+            name = None
+            if len(alias) == 2 and alias[0].lower() == "as":
+                name = alias[1].lower()
+            elif alias:
+                raise ValueError("Invalid FROM instruction: FROM {}".format(args))
+            self.stages.append(BuildStage(len(self.stages), image, name))
+
+    def find_stage(self, ref, before=None):
+        """Find stage by name or index, only looking at stages before index before"""
+        stages = self.stages if before is None else self.stages[:before]
+        if ref is None:
+            return None
+        for stage in stages:
+            if stage.name == ref.lower() or str(stage.index) == ref:
+                return stage
+
+    def _stage_refs(self, stage):
+        refs = [stage.from_image]
+        for cmd, args in stage.build_commands:
+            if cmd == "copy":
+                from_stage = parse_copy_args(args)[0]
+                if from_stage is not None:
+                    refs.append(from_stage)
+        return refs
+
+    def stage_dependencies(self, stage):
+        """Earlier stages that stage uses with FROM or COPY --from"""
+        dependencies = []
+        for ref in self._stage_refs(stage):
+            dependency = self.find_stage(ref, stage.index)
+            if dependency and dependency not in dependencies:
+                dependencies.append(dependency)
+        return dependencies
+
+    def required_stages(self):
+        """Final stage and all the stages it depends on, in Dockerfile order"""
+        required = set()
+        def visit(stage):
+            if stage.index not in required:
+                required.add(stage.index)
+                for dependency in self.stage_dependencies(stage):
+                    visit(dependency)
+        if self.stages:
+            visit(self.stages[-1])
+        return [stage for stage in self.stages if stage.index in required]
+
+    def base_images(self):
+        """External images referenced by FROM or COPY --from"""
+        images = []
+        for stage in self.stages:
+            for ref in self._stage_refs(stage):
+                if ref != "scratch" and not self.find_stage(ref, stage.index) and ref not in images:
+                    images.append(ref)
+        return images
 
     def _parse_file(self, dockerfile):
         with dockerfile.open() as f:
@@ -75,14 +202,101 @@ class DockerfileParser():
                 yield "\n".join(current_line)
                 current_line = []
 
-    def calc_build_hashes(self, parent_hash=None):
-        build_hash = sha256()
-        if parent_hash:
-            build_hash.update(parent_hash.encode())
-        for cmd, args in self.build_commands:
-            build_hash.update(cmd.encode())
-            build_hash.update(args.encode())
-            self.build_hashes.append(build_hash.hexdigest())
+    def referenced_env(self, args):
+        """Sorted names of the $VAR and ${VAR} variables args refers to"""
+        return sorted({braced or plain for braced, plain in env_reference_re.findall(args)})
+
+    def resolve_image(self, ref, stage):
+        """Hash of the image ref refers to from within stage"""
+        source = self.find_stage(ref, stage.index)
+        if source:
+            return source.image_hash
+        if ref == "scratch":
+            return ""
+        return self.base_hashes.get(ref, self.parent_hash)
+
+    def coalesce_steps(self):
+        """Merge runs of consecutive HOST or RUN steps into single steps
+
+        Every command still runs in its own subshell and the step stops at
+        the first failing one, but the run is sealed as one layer under a
+        combined hash. Returns the number of steps that were merged away.
+        """
+        merged_away = 0
+        for stage in self.stages:
+            runs = []
+            for cmd, args in stage.build_commands:
+                if runs and cmd in ("host", "run") and runs[-1][0] == cmd:
+                    runs[-1][1].append(args)
+                else:
+                    runs.append((cmd, [args]))
+            merged_away += len(stage.build_commands) - len(runs)
+            stage.build_commands = [
+                (cmd, args[0] if len(args) == 1 else " && ".join("({}\n)".format(arg) for arg in args))
+                for cmd, args in runs]
+        return merged_away
+
+    def first_affected_step(self, context, paths):
+        """First (stage, step index) whose inputs include one of the changed paths
+
+        HOST steps can read anything in the context, COPY steps read their
+        sources. Returns None when no step of the build depends on the paths.
+        """
+        context = Path(context)
+        paths = [Path(path) for path in paths]
+        for stage in self.required_stages():
+            for index, (cmd, args) in enumerate(stage.build_commands):
+                if cmd == "host" and paths:
+                    return stage, index
+                if cmd == "copy":
+                    from_stage, srcs, dest = parse_copy_args(args)
+                    if from_stage is not None:
+                        continue
+                    for src in srcs:
+                        src = Path(os.path.normpath(str(context / src)))
+                        for path in paths:
+                            if path == src or src in path.parents or path in src.parents:
+                                return stage, index
+        return None
+
+    def calc_build_hashes(self, parent_hash=None, context=None, file_hashes=None, base_hashes=None,
+                          host_digest=None):
+        """Calculate chained build hashes for every build command of every stage
+
+        External base images are looked up from base_hashes, parent_hash is
+        used for ones missing from it. HOST and RUN steps include the values
+        of the ENV variables they reference, so overriding a variable only
+        invalidates the steps from the first one that uses it. When context
+        is given, COPY steps also include a digest of their source files so
+        that changed inputs invalidate the cached layer, COPY --from steps
+        include the hash of the image they copy from. host_digest is mixed
+        into HOST steps, watch mode uses it to rebuild them when the context
+        changes.
+        """
+        self.base_hashes = base_hashes or {}
+        self.parent_hash = parent_hash or ""
+        for stage in self.stages:
+            stage.parent_hash = self.resolve_image(stage.from_image, stage)
+            stage.build_hashes = []
+            build_hash = sha256()
+            if stage.parent_hash:
+                build_hash.update(stage.parent_hash.encode())
+            for cmd, args in stage.build_commands:
+                build_hash.update(cmd.encode())
+                build_hash.update(args.encode())
+                if cmd == "host" and host_digest:
+                    build_hash.update(host_digest.encode())
+                if cmd in ("host", "run"):
+                    for name in self.referenced_env(args):
+                        if name in self.env:
+                            build_hash.update("\0{}={}".format(name, self.env[name]).encode())
+                if cmd == "copy":
+                    from_stage = parse_copy_args(args)[0]
+                    if from_stage is not None:
+                        build_hash.update(self.resolve_image(from_stage, stage).encode())
+                    elif context is not None:
+                        build_hash.update(copy_sources_digest(context, args, file_hashes).encode())
+                stage.build_hashes.append(build_hash.hexdigest())
 
     def add_env_variables(self, env_variables):
         for variable in env_variables:
@@ -90,35 +304,265 @@ class DockerfileParser():
 
 
 class ImageStorage():
+    """Image metadata store backed by an on-disk sqlite index
+
+    Subvolume xattrs remain the source of truth, the index mirrors them so
+    lookups do not need to walk the runtime directory. Use reindex() to
+    rebuild it from disk.
 
-    def __init__(self, runtime):
+    A readonly storage never writes to the index, when the index can not
+    be used as is it is rebuilt in memory instead.
+    """
+
+    def __init__(self, runtime, readonly=False):
         self.runtime = Path(runtime)
         if not self.runtime.exists():
             raise FileNotFoundError("Runtime dir {} does not exist".format(self.runtime))
 
-        self.images = {}
-        self._scan()
+        self.readonly = readonly
+        self._in_memory = False
+        self._local = threading.local()
+        try:
+            self._create_tables()
+            indexed = self.db.execute("SELECT value FROM meta WHERE key = 'indexed'").fetchone()
+        except sqlite3.OperationalError:
+            if not readonly:
+                raise
+            indexed = False  # missing or outdated index file
+        if not indexed and readonly and not self._in_memory:
+            self._in_memory = True
+            self._local = threading.local()
+            self._create_tables()
+        if not indexed:
+            self.reindex()
+
+    def _create_tables(self):
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                "name TEXT PRIMARY KEY, parent_hash TEXT, cmd TEXT, "
+                "created REAL, last_used REAL, attrs TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS images_parent ON images (parent_hash)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS tags (name TEXT PRIMARY KEY, image TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS tags_image ON tags (image)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS image_sizes (name TEXT PRIMARY KEY, size INTEGER)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS image_extents (name TEXT PRIMARY KEY, referenced INTEGER, extents BLOB)")
+
+    @property
+    def db(self):
+        """sqlite connection private to the calling thread and process"""
+        if getattr(self._local, "pid", None) != os.getpid():
+            if self._in_memory:
+                self._local.db = sqlite3.connect(":memory:")
+            elif self.readonly:
+                self._local.db = sqlite3.connect(
+                    "file:{}?mode=ro".format(pathname2url(str(self.runtime / metadata_db_name))),
+                    uri=True, timeout=60)
+            else:
+                self._local.db = sqlite3.connect(str(self.runtime / metadata_db_name), timeout=60)
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    @property
+    def images(self):
+        images = {}
+        for name, attrs in self.db.execute("SELECT name, attrs FROM images"):
+            images[name] = json.loads(attrs)
+        for name, image in self.db.execute("SELECT name, image FROM tags"):
+            images["tag-" + name] = images.get(image, {})
+        return images
 
     def _scan(self):
+        images = {}
         for image in self.runtime.iterdir():
             name = image.name
-            self.images[name] = attrs = {}
-
-            if not image.exists():
+            if name.startswith("."):
+                continue  # noby metadata, not an image
+            images[name] = self._read_attrs(image) if image.exists() else {}
+        return images
+
+    @staticmethod
+    def _read_attrs(image):
+        attrs = {}
+        for attr in os.listxattr(str(image)):
+            if not attr.startswith("user."):
                 continue
-
-            for attr in os.listxattr(str(image)):
-                if not attr.startswith("user."):
+            val = os.getxattr(str(image), attr)
+            val = val.decode()
+            key = attr[5:]
+            attrs[key] = val
+        return attrs
+
+    def reindex(self):
+        """Rebuild the index from subvolume xattrs and tag symlinks"""
+        images = self._scan()
+        with self.db:
+            self.db.execute("DELETE FROM images")
+            self.db.execute("DELETE FROM tags")
+            for name, attrs in images.items():
+                path = self.runtime / name
+                if name.startswith("tag-"):
+                    if path.is_symlink():
+                        self.db.execute("INSERT INTO tags VALUES (?, ?)",
+                                        (name[4:], Path(os.readlink(str(path))).name))
+                    continue
+                if not path.exists():
                     continue
-                val = os.getxattr(str(image), attr)
-                val = val.decode()
-                key = attr[5:]
-                attrs[key] = val
+                st = path.stat()
+                self._insert(name, attrs, st.st_mtime, st.st_atime)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('indexed', ?)", (str(time.time()),))
+        return images
+
+    def _insert(self, name, attrs, created, last_used):
+        cmd = next((key[4:] for key in attrs if key.startswith("cmd.")), None)
+        self.db.execute(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)",
+            (name, attrs.get("parent_hash"), cmd, created, last_used, json.dumps(attrs)))
+
+    def add_image(self, name, attrs):
+        now = time.time()
+        with self.db:
+            self._insert(name, attrs, now, now)
+
+    def ensure_indexed(self, name):
+        """Index an image that exists on disk if its row went missing, e.g. after a crash"""
+        if self.get(name) is None:
+            path = self.runtime / name
+            with self.db:
+                self._insert(name, self._read_attrs(path), path.stat().st_mtime, time.time())
+
+    def remove_image(self, name):
+        with self.db:
+            self.db.execute("DELETE FROM images WHERE name = ?", (name,))
+            self.db.execute("DELETE FROM image_sizes WHERE name = ?", (name,))
+            self.db.execute("DELETE FROM image_extents WHERE name = ?", (name,))
+            self.db.execute("DELETE FROM tags WHERE image = ?", (name,))
+        for artifact in (self.runtime / export_cache_name).glob(name + "-*"):
+            artifact.unlink()  # exports of the image are stale now
+
+    def touch(self, *names):
+        """Record that images were used"""
+        now = time.time()
+        with self.db:
+            self.db.executemany("UPDATE images SET last_used = ? WHERE name = ?", ((now, name) for name in names))
+
+    def get(self, name):
+        row = self.db.execute("SELECT attrs FROM images WHERE name = ?", (name,)).fetchone()
+        if row:
+            return json.loads(row[0])
+
+    def tag(self, name, image):
+        """Atomically point tag name at image"""
+        with self.db:
+            tmp_tag = self.runtime / ("tag-" + name + "-tmp")
+            if os.path.lexists(str(tmp_tag)):
+                os.unlink(str(tmp_tag))
+            os.symlink(str(self.runtime / image), str(tmp_tag))
+            os.replace(str(tmp_tag), str(self.runtime / ("tag-" + name)))
+            self.db.execute("INSERT OR REPLACE INTO tags VALUES (?, ?)", (name, image))
+
+    def untag(self, name):
+        with self.db:
+            link = self.runtime / ("tag-" + name)
+            if os.path.lexists(str(link)):
+                os.unlink(str(link))
+            self.db.execute("DELETE FROM tags WHERE name = ?", (name,))
+
+    def tags(self):
+        """Dict of tag names and the images they point to"""
+        return dict(self.db.execute("SELECT name, image FROM tags"))
+
+    def reachable(self):
+        """Images reachable from tags by following parent_hash chains"""
+        reachable = set()
+        for image in self.tags().values():
+            while image and image not in reachable:
+                reachable.add(image)
+                attrs = self.get(image) or {}
+                image = attrs.get("parent_hash")
+        return reachable
+
+    def image_size(self, name):
+        """Referenced bytes of a sealed image, cached as sealed images never change"""
+        row = self.db.execute("SELECT size FROM image_sizes WHERE name = ?", (name,)).fetchone()
+        if row:
+            return row[0]
+        size = 0
+        seen = set()
+        for root, dirs, files in os.walk(str(self.runtime / name)):
+            for entry in dirs + files:
+                st = os.lstat(os.path.join(root, entry))
+                if (st.st_dev, st.st_ino) not in seen:
+                    seen.add((st.st_dev, st.st_ino))
+                    size += st.st_blocks * 512
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO image_sizes VALUES (?, ?)", (name, size))
+        return size
+
+    def image_extents(self, name):
+        """Referenced bytes and set of (physical, length) data extents of an image
+
+        Only sealed readonly images are cached, their extents never change.
+        """
+        row = self.db.execute("SELECT referenced, extents FROM image_extents WHERE name = ?", (name,)).fetchone()
+        if row:
+            flat = array.array("Q", row[1])
+            return row[0], set(zip(flat[0::2], flat[1::2]))
+        path = self.runtime / name
+        referenced, extents = tree_extents(path)
+        try:
+            readonly = btrfs_subvol_is_readonly(path)
+        except (OSError, subprocess.CalledProcessError):
+            readonly = False  # not a btrfs subvolume
+        if readonly:
+            flat = array.array("Q", (value for extent in sorted(extents) for value in extent))
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO image_extents VALUES (?, ?, ?)",
+                                (name, referenced, flat.tobytes()))
+        return referenced, extents
+
+    def find_image_by_attr(self, key, value):
+        """Name of an image with attribute key set to value"""
+        if value is None:
+            return None
+        row = self.db.execute(
+            "SELECT name FROM images WHERE json_extract(attrs, ?) = ?", ("$." + key, value)).fetchone()
+        if row:
+            return row[0]
+
+    def parents(self):
+        """Dict of image names and their parent hashes, the whole layer tree in one query"""
+        return dict(self.db.execute("SELECT name, parent_hash FROM images"))
+
+    def cached_prefix(self, build_hashes, parent_hash=""):
+        """Number of leading build_hashes that are already built on top of parent_hash
+
+        Follows the parent_hash chain through the index and returns the
+        length of the longest built prefix whose deepest layer still exists
+        on disk, execution can start right after it.
+        """
+        parents = {}
+        for start in range(0, len(build_hashes), 500):
+            chunk = build_hashes[start:start + 500]
+            parents.update(self.db.execute(
+                "SELECT name, parent_hash FROM images WHERE name IN ({})".format(",".join("?" * len(chunk))),
+                chunk))
+        count = 0
+        for build_hash in build_hashes:
+            if build_hash not in parents or (parent_hash and parents[build_hash] != parent_hash):
+                break
+            parent_hash = build_hash
+            count += 1
+        while count and not (self.runtime / build_hashes[count - 1]).exists():
+            count -= 1  # index is stale, the subvolume was removed behind our back
+        return count
 
     def find_children(self, parent_hash):
-        for image, attrs in self.images.items():
-            if attrs.get("parent_hash") == parent_hash:
-                yield image, attrs
+        for image, attrs in self.db.execute(
+                "SELECT name, attrs FROM images WHERE parent_hash = ?", (parent_hash,)):
+            yield image, json.loads(attrs)
 
     def find_last_build_by_name(self, name):
         link = self.runtime / ("tag-" + str(name))
@@ -136,38 +580,1120 @@ class ImageStorage():
         return image.name  # its a valid image
 
 
-def btrfs_subvol_create(path):
-    subprocess.run(("btrfs", "subvolume", "create", str(path)),
+class StepLock():
+    """Exclusive lock on one build step hash, shared by all noby processes
+
+    Uses flock on a file in the runtime dir, the kernel drops the lock
+    when its holder dies. The file holds the pid of the current holder, a
+    lock acquired without waiting that still names a pid was left behind
+    by a crashed builder. The last holder removes the file on release.
+    """
+
+    def __init__(self, runtime, build_hash):
+        self.path = Path(runtime) / ".locks" / (build_hash + ".lock")
+        self.fd = None
+        self.shared = False
+
+    def _locked_current_file(self):
+        """Whether the locked fd is still the file at path, a previous holder may have removed it"""
+        try:
+            return os.fstat(self.fd).st_ino == os.stat(str(self.path)).st_ino
+        except FileNotFoundError:
+            return False
+
+    def acquire(self, blocking=True, shared=False):
+        """Take the lock, returns False if it is busy and blocking is False
+
+        A shared lock only keeps others from taking the exclusive one, gc
+        uses that to leave alone the images builders snapshot from.
+        """
+        self.path.parent.mkdir(exist_ok=True)
+        self.shared = shared
+        while True:
+            self.fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o644)
+            if shared:
+                fcntl.flock(self.fd, fcntl.LOCK_SH)
+                if self._locked_current_file():
+                    return True
+                os.close(self.fd)
+                continue
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if not blocking:
+                    os.close(self.fd)
+                    self.fd = None
+                    return False
+                holder = os.pread(self.fd, 32, 0).decode().strip()
+                print("  -> Waiting for builder {} working on the same step".format(holder or "(unknown)"))
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+                if not self._locked_current_file():
+                    os.close(self.fd)
+                    continue
+            else:
+                if not self._locked_current_file():
+                    os.close(self.fd)
+                    continue
+                holder = os.pread(self.fd, 32, 0).decode().strip()
+                if holder:
+                    print("  -> Recovering stale lock of crashed builder {}".format(holder))
+            os.ftruncate(self.fd, 0)
+            os.pwrite(self.fd, "{}\n".format(os.getpid()).encode(), 0)
+            return True
+
+    def release(self):
+        if self.fd is None:
+            return
+        last = True
+        if self.shared:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                last = False  # other shared holders remove it
+        if last:
+            #  Removed while still locked, waiters notice that and retry on a new file
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(str(self.path))
+        os.close(self.fd)  # closing drops the flock
+        self.fd = None
+
+
+class OperationSlots():
+    """Cross-process limit on the nspawn and btrfs operations that run at once
+
+    All noby processes working on a runtime share count flock files in
+    its .slots directory, an operation holds one of them while it runs.
+    Operations started while the thread already holds a slot do not take
+    another one. Without a directory nothing is limited.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.directory = None
+        self._local = threading.local()
+
+    def acquire(self):
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        if depth or self.directory is None or not self.count:
+            return
+        self.directory.mkdir(exist_ok=True)
+        paths = [str(self.directory / "{}.lock".format(index)) for index in range(self.count)]
+        for path in paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                os.close(fd)
+        else:
+            #  All busy, queue up on one of them
+            fd = os.open(paths[(os.getpid() + threading.get_ident()) % self.count], os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        self._local.fd = fd
+
+    def release(self):
+        self._local.depth -= 1
+        fd = getattr(self._local, "fd", None)
+        if not self._local.depth and fd is not None:
+            self._local.fd = None
+            os.close(fd)  # closing drops the flock
+
+    @contextlib.contextmanager
+    def hold(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+#  Set up by main() for the runtime in use, NOBY_SLOTS is the limit
+operation_slots = OperationSlots(int(os.environ.get("NOBY_SLOTS", os.cpu_count())))
+
+
+def limited(func):
+    """Run func in one of the operation_slots"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with operation_slots.hold():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class NspawnSession():
+    """Long running systemd-nspawn container for consecutive RUN steps
+
+    Commands are fed to a shell inside the container, each one runs in its
+    own /bin/sh -c with stdin detached so it can not eat the following
+    commands. image is the hash of the layer the container currently holds,
+    lock the StepLock that keeps its live target to this session.
+    """
+
+    def __init__(self, target, env=None):
+        self.target = Path(target)
+        self.env = env or {}
+        self.image = None
+        self.lock = None
+        self.steps = 0
+        self.process = subprocess.Popen(
+            self._command(), cwd=str(self.target), env=self.env,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        #  Startup cost that every reused step no longer pays
+        start = time.perf_counter()
+        self._execute("true")
+        self.startup = time.perf_counter() - start
+
+    def _command(self):
+        nspawn_cmd = nspawn_cmd_base.copy()
+        for key, val in self.env.items():
+            nspawn_cmd.extend(('--setenv', '{}={}'.format(key, val)))
+        nspawn_cmd.extend(('--register=no', '--console=pipe', '-D', str(self.target), '/bin/sh'))
+        return nspawn_cmd
+
+    def _execute(self, command):
+        marker = "noby-step-done-{}".format(os.urandom(8).hex())
+        script = "/bin/sh -c {} </dev/null; rc=$?; echo; echo {} $rc\n".format(shlex.quote(command), marker)
+        with operation_slots.hold():
+            return self._wait(marker, script)
+
+    def _wait(self, marker, script):
+        self.process.stdin.write(script.encode())
+        self.process.stdin.flush()
+        pending = ""
+        for line in self.process.stdout:
+            line = line.decode(errors="replace")
+            if line.startswith(marker):
+                if pending.strip():
+                    sys.stdout.write(pending)
+                sys.stdout.flush()
+                return int(line.split()[1])
+            #  Hold back one line, the extra echo makes sure output ends in a newline
+            sys.stdout.write(pending)
+            pending = line
+        raise ChildProcessError("RUN session container exited unexpectedly")
+
+    def run(self, command):
+        returncode = self._execute(command)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, command)
+        self.steps += 1
+
+    def close(self):
+        self.process.stdin.close()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+@limited
+def nspawn_run(target, command, *, env=None, options=(), **kwargs):
+    """Run shell command inside the target directory with systemd-nspawn
+
+    Extra keyword arguments are passed on to subprocess.run.
+    """
+    env = env or {}
+    nspawn_cmd = nspawn_cmd_base.copy()
+    for key, val in env.items():
+        nspawn_cmd.extend(('--setenv', '{}={}'.format(key, val)))
+    nspawn_cmd.extend(options)
+    nspawn_cmd.extend(('--register=no', '-D', str(target), '/bin/sh', '-c', command))
+    return subprocess.run(nspawn_cmd, cwd=str(target), shell=False, env=env, **kwargs)
+
+
+#  btrfs ioctl interface from linux/btrfs.h
+BTRFS_SUBVOL_RDONLY = 1 << 1
+BTRFS_IOC_SYNC = 0x9408
+BTRFS_IOC_SUBVOL_CREATE = 0x5000940e   # _IOW(0x94, 14, struct btrfs_ioctl_vol_args)
+BTRFS_IOC_SNAP_DESTROY = 0x5000940f    # _IOW(0x94, 15, struct btrfs_ioctl_vol_args)
+BTRFS_IOC_SNAP_CREATE_V2 = 0x50009417  # _IOW(0x94, 23, struct btrfs_ioctl_vol_args_v2)
+BTRFS_IOC_SUBVOL_GETFLAGS = 0x80089419 # _IOR(0x94, 25, __u64)
+
+BTRFS_IOC_SUBVOL_SETFLAGS = 0x4008941a # _IOW(0x94, 26, __u64)
+BTRFS_IOC_INO_LOOKUP = 0xd0009412      # _IOWR(0x94, 18, struct btrfs_ioctl_ino_lookup_args)
+BTRFS_FIRST_FREE_OBJECTID = 256
+
+#  "ioctl" talks to the kernel directly, "cli" forks the btrfs tool
+btrfs_backend = os.environ.get("NOBY_BTRFS_BACKEND", "ioctl")
+#  ioctl errors that mean the native backend is unusable here
+btrfs_fallback_errnos = (errno.ENOTTY, errno.ENOSYS, errno.EOPNOTSUPP)
+
+
+#  Arguments are mutable buffers, fcntl.ioctl refuses immutable ones over 1024 bytes
+def _btrfs_vol_args(fd, name):
+    return bytearray(struct.pack("q4088s", fd, os.fsencode(name)))
+
+
+def _btrfs_vol_args_v2(fd, name, flags=0):
+    return bytearray(struct.pack("qQQ32s4040s", fd, 0, flags, b"", os.fsencode(name)))
+
+
+def _btrfs_ioctl(path, request, arg):
+    """Run ioctl on directory path, returns False if the CLI should be used instead"""
+    if btrfs_backend != "ioctl":
+        return False
+    fd = os.open(str(path), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        fcntl.ioctl(fd, request, arg)
+    except OSError as e:
+        if e.errno in btrfs_fallback_errnos:
+            return False
+        raise
+    finally:
+        os.close(fd)
+    return True
+
+
+def _btrfs_cli(*cmd):
+    subprocess.run(("btrfs", "subvolume") + cmd,
         check=True,
         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
     )
 
-def btrfs_subvol_delete(path):
-    subprocess.run(("btrfs", "subvolume", "delete", str(path)),
-        check=True,
-        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-    )
 
+@limited
+def btrfs_subvol_create(path):
+    path = Path(path)
+    if not _btrfs_ioctl(path.parent, BTRFS_IOC_SUBVOL_CREATE, _btrfs_vol_args(0, path.name)):
+        _btrfs_cli("create", str(path))
+
+@limited
+def btrfs_subvol_delete(path):
+    path = Path(path)
+    if not _btrfs_ioctl(path.parent, BTRFS_IOC_SNAP_DESTROY, _btrfs_vol_args(0, path.name)):
+        _btrfs_cli("delete", str(path))
+
+@limited
+def btrfs_subvol_delete_many(paths, *, commit=False):
+    """Delete many subvolumes, optionally waiting for a single transaction commit"""
+    paths = [Path(path) for path in paths]
+    if not paths:
+        return
+    remaining = []
+    for path in paths:
+        if not _btrfs_ioctl(path.parent, BTRFS_IOC_SNAP_DESTROY, _btrfs_vol_args(0, path.name)):
+            remaining.append(path)
+    if remaining:
+        _btrfs_cli("delete", *(("-c",) if commit else ()), *map(str, remaining))
+    elif commit:
+        _btrfs_ioctl(paths[0].parent, BTRFS_IOC_SYNC, 0)
+
+@limited
 def btrfs_subvol_snapshot(src, dest, *, readonly=False):
-    cmd = ("btrfs", "subvolume", "snapshot", str(src), str(dest))
+    dest = Path(dest)
+    src_fd = os.open(str(src), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        flags = BTRFS_SUBVOL_RDONLY if readonly else 0
+        if _btrfs_ioctl(dest.parent, BTRFS_IOC_SNAP_CREATE_V2, _btrfs_vol_args_v2(src_fd, dest.name, flags)):
+            return
+    finally:
+        os.close(src_fd)
+    cmd = ("snapshot", str(src), str(dest))
     if readonly:
-        cmd = ("btrfs", "subvolume", "snapshot", "-r", str(src), str(dest))
-    subprocess.run(cmd,
-        check=True,
-        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-    )
+        cmd = ("snapshot", "-r", str(src), str(dest))
+    _btrfs_cli(*cmd)
+
+
+def btrfs_subvol_is_readonly(path):
+    if btrfs_backend == "ioctl":
+        fd = os.open(str(path), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            flags = bytearray(8)
+            fcntl.ioctl(fd, BTRFS_IOC_SUBVOL_GETFLAGS, flags)
+            return bool(struct.unpack("Q", flags)[0] & BTRFS_SUBVOL_RDONLY)
+        except OSError as e:
+            if e.errno not in btrfs_fallback_errnos:
+                raise
+        finally:
+            os.close(fd)
+    output = subprocess.run(("btrfs", "property", "get", "-ts", str(path), "ro"),
+                            check=True, stdout=subprocess.PIPE).stdout
+    return output.strip() == b"ro=true"
+
+
+@limited
+def btrfs_subvol_set_readonly(path, readonly):
+    if btrfs_backend == "ioctl":
+        fd = os.open(str(path), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            flags = bytearray(8)
+            fcntl.ioctl(fd, BTRFS_IOC_SUBVOL_GETFLAGS, flags)
+            flags = struct.unpack("Q", flags)[0] & ~BTRFS_SUBVOL_RDONLY
+            if readonly:
+                flags |= BTRFS_SUBVOL_RDONLY
+            fcntl.ioctl(fd, BTRFS_IOC_SUBVOL_SETFLAGS, bytearray(struct.pack("Q", flags)))
+            return
+        except OSError as e:
+            if e.errno not in btrfs_fallback_errnos:
+                raise
+        finally:
+            os.close(fd)
+    subprocess.run(("btrfs", "property", "set", "-ts", str(path), "ro", "true" if readonly else "false"),
+                   check=True, stdout=subprocess.DEVNULL)
+
+
+@contextlib.contextmanager
+def readonly_subvolume(path):
+    """Yield path, or a temporary readonly snapshot of it when it is writable
+
+    btrfs send only works on readonly subvolumes, imported images are not.
+    """
+    path = Path(path)
+    if btrfs_subvol_is_readonly(path):
+        yield path
+        return
+    snapshot = path.parent / ".send-{}-{}".format(path.name, os.getpid())
+    if snapshot.exists():
+        btrfs_subvol_delete(snapshot)  # left over by an interrupted send
+    btrfs_subvol_snapshot(path, snapshot, readonly=True)
+    try:
+        yield snapshot
+    finally:
+        btrfs_subvol_delete(snapshot)
+
+
+def btrfs_subvol_uuids(path):
+    """(uuid, received_uuid) of a subvolume, received_uuid is None unless it came from btrfs receive"""
+    output = subprocess.run(("btrfs", "subvolume", "show", str(path)),
+                            check=True, stdout=subprocess.PIPE).stdout.decode()
+    uuids = {}
+    for line in output.splitlines():
+        key, _, value = line.strip().partition(":")
+        if key in ("UUID", "Received UUID"):
+            value = value.strip()
+            uuids[key] = value if value not in ("", "-") else None
+    return uuids.get("UUID"), uuids.get("Received UUID")
+
+
+def btrfs_subvol_id(path):
+    """Id of the subvolume that path is the root of"""
+    if btrfs_backend == "ioctl":
+        args = bytearray(struct.pack("QQ4080s", 0, BTRFS_FIRST_FREE_OBJECTID, b""))
+        fd = os.open(str(path), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            fcntl.ioctl(fd, BTRFS_IOC_INO_LOOKUP, args)
+            return struct.unpack_from("Q", args)[0]
+        except OSError as e:
+            if e.errno not in btrfs_fallback_errnos:
+                raise
+        finally:
+            os.close(fd)
+    output = subprocess.run(("btrfs", "inspect-internal", "rootid", str(path)),
+                            check=True, stdout=subprocess.PIPE).stdout
+    return int(output)
+
+
+def btrfs_qgroups(path):
+    """Dict of subvolume ids and their (referenced, exclusive) bytes, None if quotas are disabled"""
+    try:
+        output = subprocess.run(("btrfs", "qgroup", "show", "--raw", str(path)),
+                                check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    qgroups = {}
+    for line in output.decode().splitlines():
+        fields = line.split()
+        if len(fields) >= 3 and fields[0].startswith("0/") and fields[1].isdigit():
+            qgroups[int(fields[0][2:])] = (int(fields[1]), int(fields[2]))
+    return qgroups
+
+
+#  FIEMAP interface from linux/fiemap.h
+FS_IOC_FIEMAP = 0xc020660b  # _IOWR('f', 11, struct fiemap)
+FIEMAP_FLAG_SYNC = 0x1
+FIEMAP_EXTENT_LAST = 0x1
+FIEMAP_EXTENT_UNKNOWN = 0x2
+FIEMAP_EXTENT_DATA_INLINE = 0x200
+fiemap_header = struct.Struct("QQIIII")
+fiemap_extent = struct.Struct("QQQQQIIII")
+
+
+def file_extents(fd, size, batch=64):
+    """Yield (physical, length, flags) of the data extents of an open file"""
+    start = 0
+    while start < size:
+        buf = bytearray(fiemap_header.size + fiemap_extent.size * batch)
+        fiemap_header.pack_into(buf, 0, start, size - start, FIEMAP_FLAG_SYNC, 0, batch, 0)
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+        mapped = fiemap_header.unpack_from(buf)[3]
+        if not mapped:
+            return
+        for i in range(mapped):
+            logical, physical, length, _, _, flags, _, _, _ = fiemap_extent.unpack_from(
+                buf, fiemap_header.size + i * fiemap_extent.size)
+            yield physical, length, flags
+            if flags & FIEMAP_EXTENT_LAST:
+                return
+        start = logical + length
+
+
+def tree_extents(path):
+    """Referenced bytes and set of (physical, length) data extents of a tree
+
+    Extents shared within the tree are counted once. Inline and unmappable
+    data counts as referenced but has no extent, it is never shared.
+    """
+    referenced = 0
+    extents = set()
+    seen = set()
+    for root, dirs, files in os.walk(str(path)):
+        for name in files:
+            file_path = os.path.join(root, name)
+            st = os.lstat(file_path)
+            if not stat.S_ISREG(st.st_mode) or (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            try:
+                fd = os.open(file_path, os.O_RDONLY | os.O_NOFOLLOW)
+            except OSError:
+                referenced += st.st_blocks * 512
+                continue
+            try:
+                for physical, length, flags in file_extents(fd, st.st_size):
+                    if flags & (FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_DATA_INLINE):
+                        referenced += length
+                    elif (physical, length) not in extents:
+                        extents.add((physical, length))
+                        referenced += length
+            except OSError as e:
+                if e.errno not in copy_fallback_errnos:
+                    raise
+                referenced += st.st_blocks * 512  # no FIEMAP support, count allocated blocks
+            finally:
+                os.close(fd)
+    return referenced, extents
+
+
+#  FIDEDUPERANGE interface from linux/fs.h
+FIDEDUPERANGE = 0xc0189436  # _IOWR(0x94, 54, struct file_dedupe_range)
+FILE_DEDUPE_RANGE_DIFFERS = 1
+dedupe_range_header = struct.Struct("QQHHI")
+dedupe_range_info = struct.Struct("qQQiI")
+dedupe_max_length = 16 * 1024 ** 2  # btrfs caps a single request at 16MiB
+
+
+def dedupe_file_range(src_fd, dest_fd, size):
+    """Share the extents of src with dest when their contents are the same
+
+    Returns the number of bytes deduplicated, the kernel compares the data
+    itself so a file that changed in between is left alone.
+    """
+    offset = 0
+    while offset < size:
+        length = min(dedupe_max_length, size - offset)
+        buf = bytearray(dedupe_range_header.size + dedupe_range_info.size)
+        dedupe_range_header.pack_into(buf, 0, offset, length, 1, 0, 0)
+        dedupe_range_info.pack_into(buf, dedupe_range_header.size, dest_fd, offset, 0, 0, 0)
+        fcntl.ioctl(src_fd, FIDEDUPERANGE, buf)
+        _, _, deduped, status, _ = dedupe_range_info.unpack_from(buf, dedupe_range_header.size)
+        if status < 0:
+            raise OSError(-status, os.strerror(-status))
+        if status == FILE_DEDUPE_RANGE_DIFFERS or not deduped:
+            break
+        offset += deduped
+    return offset
+
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int)
+copy_fallback_errnos = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF)
+
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(size) < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "TiB"
+    return "{:.1f} {}".format(size, unit) if unit != "B" else "{} B".format(size)
+
+
+class CopyStats():
+    def __init__(self):
+        self.files = 0
+        self.dirs = 0
+        self.links = 0
+        self.bytes = 0
+        self.cloned = 0
+
+    def __str__(self):
+        return "{} files, {} directories, {} symlinks ({}, {} reflinked)".format(
+            self.files, self.dirs, self.links, format_size(self.bytes), format_size(self.cloned))
+
+
+def copy_file_data(src, dest, size):
+    """Copy file contents, sharing extents when possible
+
+    Tries a FICLONE reflink first, then copy_file_range and finally a
+    plain userspace copy. Returns True when the data was reflinked.
+    """
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError as e:
+            if e.errno not in copy_fallback_errnos + (errno.EPERM,):
+                raise
+
+        offset = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                while offset < size:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - offset)
+                    if not copied:
+                        break
+                    offset += copied
+            except OSError as e:
+                if e.errno not in copy_fallback_errnos:
+                    raise
+        fsrc.seek(offset)
+        fdst.seek(offset)
+        shutil.copyfileobj(fsrc, fdst, 1 << 20)
+    return False
+
+
+def copy_metadata(src, dest, st):
+    """Copy ownership, mode, xattrs and timestamps from src to dest"""
+    is_link = stat.S_ISLNK(st.st_mode)
+    os.chown(dest, st.st_uid, st.st_gid, follow_symlinks=False)
+    for attr in os.listxattr(src, follow_symlinks=False):
+        try:
+            os.setxattr(dest, attr, os.getxattr(src, attr, follow_symlinks=False), follow_symlinks=False)
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+    if not is_link:
+        os.chmod(dest, stat.S_IMODE(st.st_mode))
+    if not is_link or os.utime in os.supports_follow_symlinks:
+        os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+def _copy_entry(src, dest):
+    st = os.lstat(src)
+    cloned = False
+    if os.path.lexists(dest) and not os.path.isdir(dest):
+        os.unlink(dest)
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src), dest)
+    elif stat.S_ISREG(st.st_mode):
+        cloned = copy_file_data(src, dest, st.st_size)
+    else:
+        os.mknod(dest, st.st_mode, st.st_rdev)
+    copy_metadata(src, dest, st)
+    return st, cloned
+
+
+def resolve_in_root(root, path, *, follow_last=False):
+    """Resolve path inside an image root like a chroot would
+
+    Symlinks in the components of path are followed within root, absolute
+    ones and .. never lead out of it. The last component is only followed
+    with follow_last or a trailing slash. Components that do not exist are
+    kept as they are.
+    """
+    root = Path(root)
+    follow_last = follow_last or str(path).endswith(("/", "/."))
+    parts = [part for part in str(path).split("/") if part not in ("", ".")]
+    resolved = []
+    links = 0
+    while parts:
+        part = parts.pop(0)
+        if part == "..":
+            if resolved:
+                resolved.pop()
+            continue
+        current = root.joinpath(*resolved, part)
+        if (parts or follow_last) and current.is_symlink():
+            links += 1
+            if links > 40:
+                raise OSError(errno.ELOOP, "Too many levels of symbolic links", str(path))
+            link = os.readlink(str(current))
+            if link.startswith("/"):
+                resolved = []
+            parts = [part for part in link.split("/") if part not in ("", ".")] + parts
+            continue
+        resolved.append(part)
+    return root.joinpath(*resolved)
+
+
+def copy_tree(srcs, dest, *, cwd=".", workers=None):
+    """Recursively copy srcs to dest like cp -r, preserving metadata
+
+    A source ending with "/." copies the directory contents into dest.
+    Files are copied by a thread pool, returns CopyStats.
+    """
+    stats = CopyStats()
+    dest = str(dest)
+    dirs = []
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = []
+
+        def copy_file(src, target):
+            futures.append(pool.submit(_copy_entry, src, target))
+
+        for src in srcs:
+            name = os.path.basename(src.rstrip("/"))
+            src = os.path.join(str(cwd), src)
+            if not os.path.lexists(src):
+                raise FileNotFoundError("COPY source {} does not exist".format(src))
+            if os.path.isdir(dest):
+                target = dest if name in (".", "") else os.path.join(dest, name)
+            else:
+                target = dest
+
+            if not os.path.isdir(src) or os.path.islink(src):
+                copy_file(src, target)
+                continue
+
+            for root, subdirs, files in os.walk(src):
+                root_target = os.path.join(target, os.path.relpath(root, src))
+                #  Like cp -r, directories that already exist keep their metadata
+                if not os.path.isdir(root_target):
+                    os.makedirs(root_target)
+                    dirs.append((root, os.path.normpath(root_target)))
+                for name in files:
+                    copy_file(os.path.join(root, name), os.path.join(root_target, name))
+                for name in subdirs:
+                    path = os.path.join(root, name)
+                    if os.path.islink(path):
+                        copy_file(path, os.path.join(root_target, name))
+
+        for future in concurrent.futures.as_completed(futures):
+            st, cloned = future.result()
+            if stat.S_ISLNK(st.st_mode):
+                stats.links += 1
+            else:
+                stats.files += 1
+                if stat.S_ISREG(st.st_mode):
+                    stats.bytes += st.st_size
+                    stats.cloned += st.st_size if cloned else 0
+
+    #  Metadata of created directories last, so that their mtimes survive the file copies
+    for src, target in reversed(dirs):
+        copy_metadata(src, target, os.lstat(src))
+        stats.dirs += 1
+    return stats
 
 
-def newest_file(context, cmdargs):
+class FileHashIndex():
+    """Persistent cache of file content digests
+
+    Entries are keyed by (path, inode, size, mtime_ns) so that a file is
+    only read again when its stat information changes. A readonly index
+    uses the digests it finds but never writes new ones.
+    """
+
+    def __init__(self, db_path=":memory:", readonly=False):
+        self.readonly = readonly
+        if readonly and str(db_path) != ":memory:":
+            try:
+                self.db = sqlite3.connect("file:{}?mode=ro".format(pathname2url(str(db_path))), uri=True)
+                self.db.execute("SELECT 1 FROM file_hashes LIMIT 1")
+                return
+            except sqlite3.OperationalError:
+                pass  # no usable cache, every file is read
+        self.db = sqlite3.connect(str(db_path) if not readonly else ":memory:", timeout=60)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS file_hashes ("
+            "path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime_ns INTEGER, digest TEXT)")
+
+    def cached_digest(self, path, st):
+        """Digest of path if it is known for its current stat information"""
+        row = self.db.execute(
+            "SELECT inode, size, mtime_ns, digest FROM file_hashes WHERE path = ?", (str(path),)).fetchone()
+        if row and tuple(row[:3]) == (st.st_ino, st.st_size, st.st_mtime_ns):
+            return row[3]
+
+    def store(self, path, st, digest):
+        """Remember a digest that was calculated while reading path for other reasons"""
+        if self.readonly:
+            return
+        self.db.execute(
+            "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?)",
+            (str(path), st.st_ino, st.st_size, st.st_mtime_ns, digest))
+
+    def file_digest(self, path, st=None):
+        path = str(path)
+        if st is None:
+            st = os.stat(path)
+        digest = self.cached_digest(path, st)
+        if digest:
+            return digest
+
+        digest = sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        self.store(path, st, digest)
+        return digest
+
+    def commit(self):
+        if not self.readonly:
+            self.db.commit()
+
+
+def tree_digest(src, file_hashes=None):
+    """Digest of names, modes and contents of a file or directory tree"""
+    if file_hashes is None:
+        file_hashes = FileHashIndex()
+    digest = sha256()
+    src = Path(src)
+    if not os.path.lexists(str(src)):
+        digest.update(b"missing")
+        return digest.hexdigest()
+
+    def update(path, relpath):
+        st = os.lstat(str(path))
+        digest.update("{}\0{:o}\0".format(relpath, st.st_mode).encode())
+        if os.path.islink(str(path)):
+            digest.update(os.readlink(str(path)).encode())
+        elif os.path.isfile(str(path)):
+            digest.update(file_hashes.file_digest(path, st).encode())
+
+    update(src, ".")
+    if src.is_dir() and not src.is_symlink():
+        for root, dirs, files in os.walk(str(src)):
+            dirs.sort()
+            for name in sorted(dirs + files):
+                path = Path(root) / name
+                update(path, str(path.relative_to(src)))
+    return digest.hexdigest()
+
+
+def copy_sources_digest(context, cmdargs, file_hashes=None):
+    """Digest of all the source trees of a COPY instruction"""
     *srcs, dest = shlex.split(cmdargs)
-    mtime = 0
+    digest = sha256()
     for src in srcs:
-        src = context / src
-        for file in src.glob('**/*'):
-            fmtime = file.stat().st_mtime
-            if fmtime > mtime:
-                mtime = fmtime
-    return mtime
+        digest.update(tree_digest(Path(context) / src, file_hashes).encode())
+    return digest.hexdigest()
+
+
+class Tracer():
+    """Records timed build phase spans as Chrome trace events"""
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.steps = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """Time the enclosed block, args can be updated from within it"""
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.events.append({
+                    "name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                    "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6,
+                    "args": args,
+                })
+
+    def step(self, label, number, build_hash, cmd, cached, duration, copied=None):
+        """Record a finished build step for the summary and as a "step" span"""
+        end = time.perf_counter()
+        args = {"step": label + number, "hash": build_hash, "cmd": cmd, "cache": "hit" if cached else "miss"}
+        if copied is not None:
+            args["bytes"] = copied
+        with self.lock:
+            self.steps.append((label, number, build_hash, cmd, cached, duration, copied))
+            self.events.append({
+                "name": "step", "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                "ts": (end - duration - self.origin) * 1e6, "dur": duration * 1e6,
+                "args": args,
+            })
+
+    def write(self, path):
+        with open(str(path), "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+    def print_summary(self):
+        if not self.steps:
+            return
+        print("==> Build summary")
+        print("  {:12} {:16} {:5} {:6} {:>9} {:>11}".format("STEP", "HASH", "CMD", "CACHE", "TIME", "COPIED"))
+        for label, number, build_hash, cmd, cached, duration, copied in self.steps:
+            print("  {:12} {:16} {:5} {:6} {:>8.2f}s {:>11}".format(
+                label + number, build_hash[:16], cmd, "hit" if cached else "miss", duration,
+                format_size(copied) if copied is not None else "-"))
+        print("  -> Total {:.2f}s".format(time.perf_counter() - self.origin))
+
+
+def schedule(dependencies, func, jobs=None):
+    """Call func(key) for every key once all its dependencies have succeeded
+
+    Independent keys run concurrently on at most jobs threads. Returns the
+    set of succeeded keys and a dict of failed keys with their errors, keys
+    whose dependencies failed are not run and are reported as failed.
+    """
+    pending = dict(dependencies)
+    done, failed = set(), {}
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        running = {}
+        while pending or running:
+            for key, deps in list(pending.items()):
+                if deps & set(failed):
+                    failed[key] = "dependency failed"
+                    del pending[key]
+                elif deps <= done:
+                    running[pool.submit(func, key)] = key
+                    del pending[key]
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                key = running.pop(future)
+                try:
+                    future.result()
+                    done.add(key)
+                except Exception as e:
+                    failed[key] = e
+    return done, failed
+
+
+def resolve_build_hashes(r, df, context, readonly=False, changed=None):
+    """Locate base images of the dockerfile and calculate its build hashes
+
+    With readonly the base images are not marked as used and nothing is printed.
+    changed paths of the context invalidate HOST steps, see watch_build().
+    """
+    base_hashes = {}
+    for image in df.base_images():
+        parent_hash = r.find_last_build_by_name(image)
+        if not parent_hash:
+            raise FileNotFoundError("Image with name {} not found".format(image))
+        if not readonly:
+            print("Using parent image {}".format(parent_hash[:16]))
+            r.touch(parent_hash)
+        base_hashes[image] = parent_hash
+
+    file_hashes = FileHashIndex(r.runtime / metadata_db_name, readonly=readonly)
+    host_digest = None
+    if changed:
+        digest = sha256()
+        for path in sorted(changed):
+            digest.update(str(Path(path).relative_to(context)).encode())
+            digest.update(tree_digest(path, file_hashes).encode())
+        host_digest = digest.hexdigest()
+    df.calc_build_hashes(context=context, file_hashes=file_hashes, base_hashes=base_hashes,
+                         host_digest=host_digest)
+    file_hashes.commit()
+
+
+def build_stage(r, df, stage, context, args, label="", tracer=None):
+    """Build all steps of a stage, returns hash of the resulting image"""
+    runtime = r.runtime
+    parent_hash = stage.parent_hash
+    total_build_steps = len(stage.build_commands)
+    if tracer is None:
+        tracer = Tracer()
+    use_session = getattr(args, "run_session", False)
+    session = None
+    step_lock = None
+    target_lock = None
+
+    def close_session():
+        nonlocal session
+        if session is not None:
+            session.close()
+            btrfs_subvol_delete(session.target)
+            if session.lock is not None:
+                session.lock.release()
+            if session.steps > 1:
+                print("  -> RUN session ran {} steps, saved about {:.2f}s of container startup".format(
+                    session.steps, session.startup * (session.steps - 1)))
+            session = None
+
+    #  Skip the longest already built prefix of the hash chain at once
+    cached = 0 if args.no_cache else r.cached_prefix(stage.build_hashes, parent_hash)
+    if cached:
+        print("==> {}Using cached steps 1-{} of {} {}".format(
+            label, cached, total_build_steps, stage.build_hashes[cached - 1][:16]))
+        r.touch(*stage.build_hashes[:cached])
+        parent_hash = stage.build_hashes[cached - 1]
+        for current_build_step in range(cached):
+            tracer.step(label, "{}/{}".format(current_build_step + 1, total_build_steps),
+                        stage.build_hashes[current_build_step], stage.build_commands[current_build_step][0], True, 0)
+
+    next_step = cached
+    try:
+        while next_step < total_build_steps:
+            current_build_step = next_step
+            next_step += 1
+            cmd, cmdargs = stage.build_commands[current_build_step]
+            build_step_hash = stage.build_hashes[current_build_step]
+            step_start = time.perf_counter()
+            step_number = "{}/{}".format(current_build_step + 1, total_build_steps)
+            span_args = {"step": step_number, "hash": build_step_hash, "cmd": cmd}
+
+            print("==> {}Building step {} {}".format(label, step_number, build_step_hash[:16]))
+
+            target = runtime / (build_step_hash + "-init")
+            final_target = runtime / build_step_hash
+            target_lock = None
+
+            #  Only one builder works on a step, the others wait and reuse its result
+            step_lock = StepLock(runtime, build_step_hash)
+            with tracer.span("lock", **span_args) as lock_args:
+                step_lock.acquire()
+            #  Whether the step is cached is only known after waiting for the lock
+            lock_args["cache"] = span_args["cache"] = "miss"
+
+            ## parent image checks
+            if final_target.exists():
+                if args.no_cache:
+                    btrfs_subvol_delete(final_target)
+                    r.remove_image(build_step_hash)
+                else:
+                    previous_parent_hash = ""
+                    try:
+                        previous_parent_hash = os.getxattr(str(final_target), b"user.parent_hash").decode()
+                    except:
+                        pass
+                    if parent_hash and parent_hash != previous_parent_hash:
+                        print("  -> parent image hash changed")
+                        btrfs_subvol_delete(final_target)
+                        r.remove_image(build_step_hash)
+                    else:
+                        print("  -> Using cached image")
+                        lock_args["cache"] = "hit"
+                        r.ensure_indexed(build_step_hash)
+                        r.touch(build_step_hash)
+                        parent_hash = build_step_hash
+                        tracer.step(label, step_number, build_step_hash, cmd, True, time.perf_counter() - step_start)
+                        step_lock.release()
+                        close_session()
+                        continue
+
+            in_session = use_session and cmd == "run"
+            if session is not None and (not in_session or session.image != parent_hash):
+                close_session()
+
+            if session is not None:
+                #  Keep working in the live container of the previous RUN step
+                target = session.target
+                print("  -> Reusing RUN session")
+            else:
+                #  A RUN session keeps its target locked until it is closed, the
+                #  step lock is released as soon as the step is sealed
+                target_lock = StepLock(runtime, target.name)
+                if not target_lock.acquire(blocking=False):
+                    print("  -> Another builder runs a RUN session in {}".format(target.name[:16]))
+                    target = runtime / "{}-{}-init".format(build_step_hash, os.urandom(4).hex())
+                    target_lock = None  # nobody else uses this name
+
+                if target.exists():
+                    print("  -> Deleting incomplete image")
+                    btrfs_subvol_delete(target)
+
+                with tracer.span("snapshot", **span_args):
+                    if parent_hash:
+                        #  Keep gc away from the parent while snapshotting it
+                        parent_lock = StepLock(runtime, parent_hash)
+                        parent_lock.acquire(shared=True)
+                        try:
+                            removed = not (runtime / parent_hash).exists()
+                            if not removed:
+                                btrfs_subvol_snapshot(runtime / parent_hash, target)
+                        finally:
+                            parent_lock.release()
+                    else:
+                        removed = False
+                        btrfs_subvol_create(target)
+                if removed:
+                    #  Removed by a concurrent gc or build --rm, build it again
+                    if parent_hash not in stage.build_hashes[:current_build_step]:
+                        raise FileNotFoundError("Parent image {} was removed".format(parent_hash))
+                    next_step = r.cached_prefix(stage.build_hashes[:current_build_step - 1], stage.parent_hash)
+                    parent_hash = stage.build_hashes[next_step - 1] if next_step else stage.parent_hash
+                    print("  -> Parent image was removed, building again from step {}/{}".format(
+                        next_step + 1, total_build_steps))
+                    step_lock.release()
+                    if target_lock is not None:
+                        target_lock.release()
+                    continue
+                if in_session:
+                    with tracer.span("session start", **span_args):
+                        session = NspawnSession(target, df.env)
+                    session.lock = target_lock
+
+            ## Run build step
+            host_env = {
+                "TARGET": str(target),
+                "CONTEXT": str(context)
+            }
+            host_env.update(df.env)
+            copied = None
+            with tracer.span(cmd, **span_args) as span:
+                if cmd == "host":
+                    print('  -> HOST {}'.format(cmdargs))
+                    subprocess.run(cmdargs, cwd=str(context), check=True, shell=True, env=host_env)
+
+                elif cmd == "run":
+                    print('  -> RUN {}'.format(cmdargs))
+                    if session is not None:
+                        session.run(cmdargs)
+                    else:
+                        nspawn_run(target, cmdargs, env=df.env, check=True)
+
+                elif cmd == "copy":
+                    print("  -> COPY {}".format(cmdargs))
+                    from_stage, srcs, dest = parse_copy_args(cmdargs)
+                    source = context
+                    if from_stage is not None:
+                        #  Paths are inside the source image, copy from its sealed subvolume
+                        #  without letting its symlinks point at the host
+                        source = runtime / df.resolve_image(from_stage, stage)
+                        srcs = [os.path.relpath(str(resolve_in_root(source, src)), str(source)) +
+                                ("/." if src.endswith("/.") else "") for src in srcs]
+                    dest = resolve_in_root(target, dest, follow_last=True)
+                    if len(srcs) > 1 and not dest.is_dir():
+                        raise NotADirectoryError("Destination must be a directory")
+                    stats = copy_tree(srcs, dest, cwd=source)
+                    print("  -> Copied {}".format(stats))
+                    copied = span["bytes"] = stats.bytes
+
+            ## Seal build image
+            with tracer.span("seal", **span_args):
+                os.setxattr(str(target), b"user.parent_hash", parent_hash.encode())
+                for attr in ("user.cmd.host", "user.cmd.run", "user.cmd.copy"):
+                    try:
+                        os.removexattr(str(target), attr.encode())
+                    except:
+                        pass
+                os.setxattr(str(target), "user.cmd.{}".format(cmd).encode(), cmdargs.encode())
+
+            with tracer.span("readonly snapshot", **span_args):
+                btrfs_subvol_snapshot(target, final_target, readonly=True)
+            if session is not None:
+                session.image = build_step_hash
+            else:
+                with tracer.span("cleanup", **span_args):
+                    btrfs_subvol_delete(target)
+            r.add_image(build_step_hash, {"parent_hash": parent_hash, "cmd." + cmd: cmdargs})
+            step_lock.release()
+            if session is None and target_lock is not None:
+                target_lock.release()
+
+            parent_hash = build_step_hash
+            tracer.step(label, step_number, build_step_hash, cmd, False, time.perf_counter() - step_start, copied)
+
+    finally:
+        close_session()
+        if step_lock is not None:
+            step_lock.release()
+        if target_lock is not None:
+            target_lock.release()
+
+    return parent_hash
 
 
 def build(args):
@@ -179,183 +1705,933 @@ def build(args):
     if not dockerfile.is_file():
         raise FileNotFoundError("{} does not exist".format(dockerfile))
 
-    runtime = Path(args.runtime).resolve()
-    r = ImageStorage(runtime)
+    if getattr(args, "check", False):
+        return check_build(args, context, dockerfile)
+    if getattr(args, "watch", False):
+        return watch_build(args, context, dockerfile)
 
-    df = DockerfileParser(dockerfile)
-    if not df.build_commands:
-        print("Nothing to do")
-        return
+    tracer = Tracer()
+    try:
+        _build(args, context, dockerfile, tracer)
+    finally:
+        if getattr(args, "trace", None):
+            tracer.write(args.trace)
+            print("==> Wrote build trace to {}".format(args.trace))
 
-    if args.env:
-        df.add_env_variables(args.env)
-
-    #  Locate base image for this dockerfile
-    parent_hash = ""
-    if df.from_image != "scratch":
-        parent_hash = r.find_last_build_by_name(df.from_image)
-        if not parent_hash:
-            raise FileNotFoundError("Image with name {} not found".format(df.from_image))
-        print("Using parent image {}".format(parent_hash[:16]))
 
-    #  Update build hashes based on base image
-    df.calc_build_hashes(parent_hash=parent_hash)
-    total_build_steps = len(df.build_commands)
+def squashed_name(image_hash):
+    return sha256("squash\0{}".format(image_hash).encode()).hexdigest()
 
-    #  Early exit if image is already built
-    if not args.no_cache and args.rm:
-        if (runtime / df.build_hashes[-1]).exists():
-            print("==> Already built {}".format(df.build_hashes[-1][:16]))
-            return
-
-    #  Do the build
-    for current_build_step, (cmd, cmdargs) in enumerate(df.build_commands):
-        build_step_hash = df.build_hashes[current_build_step]
 
-        print("==> Building step {}/{} {}".format(current_build_step + 1, total_build_steps, build_step_hash[:16]))
+def squash_image(r, image_hash):
+    """Seal image_hash again without a parent, returns the hash of the squashed image
 
-        target = runtime / (build_step_hash + "-init")
-        final_target = runtime / build_step_hash
-        host_env = {
-            "TARGET": str(target),
-            "CONTEXT": str(context)
-        }
-        host_env.update(df.env)
-
-        ## parent image checks
+    A snapshot already holds the whole tree, only the parent_hash chain
+    goes away so gc can drop the layers once no other image uses them.
+    """
+    runtime = r.runtime
+    squashed = squashed_name(image_hash)
+    final_target = runtime / squashed
+    lock = StepLock(runtime, squashed)
+    lock.acquire()
+    try:
         if final_target.exists():
-            if args.no_cache:
-                btrfs_subvol_delete(final_target)
-            else:
-                previous_parent_hash = ""
-                try:
-                    previous_parent_hash = os.getxattr(str(final_target), b"user.parent_hash").decode()
-                except:
-                    pass
-                if parent_hash and parent_hash != previous_parent_hash:
-                    print("  -> parent image hash changed")
-                    btrfs_subvol_delete(final_target)
-                else:
-                    print("  -> Using cached image")
-                    parent_hash = build_step_hash
-                    continue
+            print("==> Using squashed image {}".format(squashed[:16]))
+            r.ensure_indexed(squashed)
+            r.touch(squashed)
+            return squashed
 
+        print("==> Squashing {} into {}".format(image_hash[:16], squashed[:16]))
+        target = runtime / (squashed + "-init")
         if target.exists():
-            print("  -> Deleting incomplete image")
             btrfs_subvol_delete(target)
+        btrfs_subvol_snapshot(runtime / image_hash, target)
+        attrs = {}
+        for attr in os.listxattr(str(target)):
+            if attr.startswith("user.cmd."):
+                os.removexattr(str(target), attr)
+            elif attr.startswith("user."):
+                attrs[attr[5:]] = os.getxattr(str(target), attr).decode()
+        attrs.update({"parent_hash": "", "squashed_from": image_hash})
+        for key in ("parent_hash", "squashed_from"):
+            os.setxattr(str(target), "user.{}".format(key).encode(), attrs[key].encode())
+        btrfs_subvol_snapshot(target, final_target, readonly=True)
+        btrfs_subvol_delete(target)
+        r.add_image(squashed, attrs)
+        return squashed
+    finally:
+        lock.release()
+
+
+def check_build(args, context, dockerfile):
+    """Report which steps of a build are cached without changing anything
 
-        if parent_hash:
-            btrfs_subvol_snapshot(runtime / parent_hash, target)
+    Exits with 0 when the image is built and tagged as requested, with 2
+    when a build is needed.
+    """
+    r = open_storage(Path(args.runtime).resolve(), readonly=True)
+    df = DockerfileParser(dockerfile)
+    if args.env:
+        df.add_env_variables(args.env)
+    if getattr(args, "coalesce", False):
+        df.coalesce_steps()
+    resolve_build_hashes(r, df, context, readonly=True)
+
+    steps = []
+    for stage in df.required_stages():
+        for number, ((cmd, cmdargs), build_hash) in enumerate(zip(stage.build_commands, stage.build_hashes)):
+            steps.append({
+                "stage": stage.label, "step": "{}/{}".format(number + 1, len(stage.build_hashes)),
+                "hash": build_hash, "cmd": cmd,
+                "cached": not args.no_cache and r.get(build_hash) is not None and (r.runtime / build_hash).exists(),
+            })
+    image_hash = df.stages[-1].image_hash
+    if getattr(args, "squash", False) and image_hash:
+        image_hash = squashed_name(image_hash)
+    built = bool(image_hash) and not args.no_cache and (r.runtime / image_hash).exists()
+    tagged = not args.tag or r.tags().get(args.tag) == image_hash
+    status = {"image": image_hash, "built": built, "tag": args.tag, "tagged": tagged,
+              "up_to_date": built and tagged, "steps": steps}
+
+    if args.json:
+        print(json.dumps(status, indent=2))
+    else:
+        print("==> Checking {}".format(dockerfile))
+        multistage = len(df.stages) > 1
+        for step in steps:
+            print("  -> {:12} {:16} {:5} {}".format(
+                ("[{}] ".format(step["stage"]) if multistage else "") + step["step"],
+                step["hash"][:16], step["cmd"], "cached" if step["cached"] else "missing"))
+        if status["up_to_date"]:
+            print("==> Up to date {}".format(image_hash[:16]))
+        elif built:
+            print("==> Built {} but not tagged as {}".format(image_hash[:16], args.tag))
         else:
-            btrfs_subvol_create(target)
-
-        ## Run build step
-        if cmd == "host":
-            print('  -> HOST {}'.format(cmdargs))
-            subprocess.run(cmdargs, cwd=str(context), check=True, shell=True, env=host_env)
-
-        elif cmd == "run":
-            print('  -> RUN {}'.format(cmdargs))
-            nspawn_cmd = nspawn_cmd_base.copy()
-            for key, val in df.env.items():
-                nspawn_cmd.extend(('--setenv', '{}={}'.format(key, val)))
-            nspawn_cmd.extend(('--register=no', '-D', str(target), '/bin/sh', '-c', cmdargs))
-            subprocess.run(nspawn_cmd, cwd=str(target), check=True, shell=False, env=df.env)
-
-        elif cmd == "copy":
-            print("  -> COPY {}".format(cmdargs))
-            *srcs, dest = shlex.split(cmdargs)
-            if Path(dest).is_absolute():
-                dest = target / dest[1:]
-            else:
-                dest = target / dest
-            if len(srcs) > 1 and not dest.is_dir():
-                raise NotADirectoryError("Destination must be a directory")
-            cmd = ['cp', '-rv']
-            cmd.extend(srcs)
-            cmd.append(str(dest))
-            subprocess.run(cmd, cwd=str(context), check=True, shell=False, env=host_env)
-
-        ## Seal build image
-        os.setxattr(str(target), b"user.parent_hash", parent_hash.encode())
-        for attr in ("user.cmd.host", "user.cmd.run"):
+            print("==> Needs build {}".format(image_hash[:16]))
+    if not status["up_to_date"]:
+        sys.exit(2)
+
+
+class Inotify():
+    """Minimal inotify binding over ctypes that watches whole directory trees"""
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(str(path)), self.MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOENT:
+                return  # removed before we got to it
+            raise OSError(err, os.strerror(err), str(path))
+        self.watches[wd] = Path(path)
+
+    def watch_tree(self, path):
+        self.add_watch(path)
+        for root, dirs, files in os.walk(str(path)):
+            for name in dirs:
+                self.add_watch(Path(root) / name)
+
+    def read(self):
+        """Changed paths from the events that are waiting in the queue"""
+        paths = set()
+        data = os.read(self.fd, 1 << 16)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                paths.update(self.watches.values())  # lost events, assume everything changed
+                continue
+            if wd not in self.watches:
+                continue
+            path = self.watches[wd] / os.fsdecode(name) if name else self.watches[wd]
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self.watch_tree(path)
+            paths.add(path)
+        return paths
+
+    def wait(self, debounce):
+        """Block until something changes, return all paths changed until debounce seconds pass quietly"""
+        select.select([self.fd], [], [])
+        paths = self.read()
+        while select.select([self.fd], [], [], debounce)[0]:
+            paths.update(self.read())
+        return paths
+
+    def drain(self):
+        """Changed paths from all events queued so far, without blocking"""
+        paths = set()
+        while select.select([self.fd], [], [], 0)[0]:
+            paths.update(self.read())
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watch_build(args, context, dockerfile):
+    """Build, then rebuild from the first affected step whenever inputs change
+
+    The tag keeps pointing at the last successful image while a rebuild
+    runs. HOST steps do not hash the context, so the paths changed since
+    watching started are mixed into their hashes, see resolve_build_hashes().
+    """
+    inotify = Inotify()
+    inotify.watch_tree(context)
+    if context not in dockerfile.parents:
+        inotify.add_watch(dockerfile.parent)
+    changed = set()
+    try:
+        while True:
             try:
-                os.removexattr(str(target), attr.encode())
-            except:
-                pass
-        os.setxattr(str(target), "user.cmd.{}".format(cmd).encode(), cmdargs.encode())
+                _build(args, context, dockerfile, Tracer(), changed)
+            except Exception as e:
+                print("==> Build failed: {}".format(e))
+            #  HOST steps may write into the context, do not rebuild because of that
+            written = inotify.drain()
+            if written:
+                print("  -> Ignoring {} paths changed during the build".format(len(written)))
+            print("==> Watching {} for changes".format(context))
+
+            while True:
+                paths = inotify.wait(args.debounce)
+                if dockerfile in paths:
+                    print("==> {} changed, rebuilding".format(dockerfile.name))
+                    break
+                paths = {path for path in paths if context in path.parents}
+                try:
+                    affected = DockerfileParser(dockerfile).first_affected_step(context, paths)
+                except (OSError, ValueError):
+                    affected = None
+                if affected is not None:
+                    stage, index = affected
+                    print("==> {} paths changed, rebuilding from {}step {}/{}".format(
+                        len(paths), "[{}] ".format(stage.label) if stage.name else "",
+                        index + 1, len(stage.build_commands)))
+                    changed.update(paths)
+                    break
+                print("  -> Ignoring changes to {} paths the build does not use".format(len(paths)))
+    finally:
+        inotify.close()
+
+
+def _build(args, context, dockerfile, tracer, changed=None):
+    runtime = Path(args.runtime).resolve()
+    with tracer.span("scan"):
+        r = open_storage(runtime)
 
-        btrfs_subvol_snapshot(target, final_target, readonly=True)
-        btrfs_subvol_delete(target)
+    with tracer.span("parse"):
+        df = DockerfileParser(dockerfile)
+    if not df.build_commands:
+        print("Nothing to do")
+        return
 
-        parent_hash = build_step_hash
+    if args.env:
+        df.add_env_variables(args.env)
+    if getattr(args, "coalesce", False):
+        print("==> Coalesced runs of HOST and RUN steps, {} fewer layers".format(df.coalesce_steps()))
+
+    #  Update build hashes based on base images and COPY sources
+    with tracer.span("hashing"):
+        resolve_build_hashes(r, df, context, changed=changed)
+    image_hash = df.stages[-1].image_hash
+
+    #  Skip straight to tagging if the image is already built,
+    #  otherwise build stages that do not depend on each other in parallel
+    stages = df.required_stages()
+    if not args.no_cache and r.get(image_hash) is not None and (runtime / image_hash).exists():
+        print("==> Already built {}".format(image_hash[:16]))
+        r.touch(image_hash)
+        for stage in stages:
+            label = "[{}] ".format(stage.label) if len(stages) > 1 else ""
+            for number, ((cmd, cmdargs), build_hash) in enumerate(zip(stage.build_commands, stage.build_hashes)):
+                tracer.step(label, "{}/{}".format(number + 1, len(stage.build_hashes)), build_hash, cmd, True, 0)
+    elif len(stages) == 1:
+        build_stage(r, df, stages[0], context, args, tracer=tracer)
+    else:
+        print("==> Building {} stages".format(len(stages)))
+        dependencies = {stage.index: {dep.index for dep in df.stage_dependencies(stage)} for stage in stages}
+        def build_index(index):
+            stage = df.stages[index]
+            return build_stage(r, df, stage, context, args, label="[{}] ".format(stage.label), tracer=tracer)
+        done, failed = schedule(dependencies, build_index)
+        for index, error in failed.items():
+            if isinstance(error, Exception):
+                raise error
+
+    if getattr(args, "squash", False):
+        with tracer.span("squash"):
+            image_hash = squash_image(r, image_hash)
 
     #  After build cleanup
     if args.rm:
         print("==> Cleanup")
-        for build_hash in df.build_hashes[:-1]:
-            target = runtime / build_hash
-            if target.exists():
-                print("  -> Remove intermediate image {}".format(build_hash[:16]))
-                btrfs_subvol_delete(target)
-
-    print("==> Successfully built {}".format(parent_hash[:16]))
+        intermediates = []
+        for stage in stages:
+            for build_hash in stage.build_hashes:
+                if build_hash != image_hash and build_hash not in intermediates and (runtime / build_hash).exists():
+                    intermediates.append(build_hash)
+        #  Like gc, leave alone the layers other builders are using
+        locks = []
+        for build_hash in intermediates[:]:
+            lock = StepLock(runtime, build_hash)
+            if not lock.acquire(blocking=False):
+                print("  -> Skipping {}, it is in use by a builder".format(build_hash[:16]))
+                intermediates.remove(build_hash)
+                continue
+            print("  -> Remove intermediate image {}".format(build_hash[:16]))
+            locks.append(lock)
+        try:
+            with tracer.span("remove intermediates", count=len(intermediates)):
+                btrfs_subvol_delete_many(runtime / build_hash for build_hash in intermediates)
+            for build_hash in intermediates:
+                r.remove_image(build_hash)
+        finally:
+            for lock in locks:
+                lock.release()
+
+    tracer.print_summary()
+    print("==> Successfully built {}".format(image_hash[:16]))
 
     if args.tag:
-        tmp_tag = runtime / ("tag-" + args.tag + "-tmp")
-        if tmp_tag.exists():
-            os.unlink(str(tmp_tag))
-        os.symlink(str(runtime / parent_hash), str(tmp_tag))
-        os.replace(str(tmp_tag), str(runtime / ("tag-" + args.tag)))
-        print("==> Tagged image {} as {}".format(parent_hash[:16], args.tag))
+        r.tag(args.tag, image_hash)
+        print("==> Tagged image {} as {}".format(image_hash[:16], args.tag))
+
+
+def load_manifest(manifest):
+    """Parse a build-all manifest
+
+    Every non blank, non comment line is "CONTEXT DOCKERFILE TAG". Relative
+    contexts are relative to the manifest and dockerfiles are relative to
+    their context, like the build -f option.
+    """
+    manifest = Path(manifest).resolve()
+    entries = {}
+    with manifest.open() as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                context, dockerfile, tag = shlex.split(line)
+            except ValueError:
+                raise ValueError("{}:{}: expected CONTEXT DOCKERFILE TAG".format(manifest, lineno))
+            if tag in entries:
+                raise ValueError("{}:{}: duplicate tag {}".format(manifest, lineno, tag))
+            entries[tag] = (manifest.parent / context).resolve(), dockerfile
+    return entries
+
+
+def manifest_dependencies(entries):
+    """Map every manifest tag to the manifest tags its FROM image depends on"""
+    dependencies = {}
+    for tag, (context, dockerfile) in entries.items():
+        dockerfile = Path(dockerfile)
+        if not dockerfile.is_absolute():
+            dockerfile = context / dockerfile
+        df = DockerfileParser(dockerfile)
+        dependencies[tag] = set(df.base_images()) & set(entries)
+
+    #  Detect cycles, they would never get scheduled
+    visiting, done = set(), set()
+    def visit(tag):
+        if tag in done:
+            return
+        if tag in visiting:
+            raise ValueError("Dependency cycle involving {}".format(tag))
+        visiting.add(tag)
+        for dependency in dependencies[tag]:
+            visit(dependency)
+        visiting.discard(tag)
+        done.add(tag)
+    for tag in dependencies:
+        visit(tag)
+    return dependencies
+
+
+def build_all(args):
+    entries = load_manifest(args.manifest)
+    dependencies = manifest_dependencies(entries)
+    print("==> Building {} images with {} workers".format(len(entries), args.jobs))
+
+    def build_entry(tag):
+        context, dockerfile = entries[tag]
+        print("==> [{}] Start build of {}".format(tag, dockerfile))
+        try:
+            build(argparse.Namespace(
+                runtime=args.runtime, path=str(context), file=dockerfile, tag=tag,
+                no_cache=args.no_cache, rm=args.rm, env=args.env))
+        except Exception as e:
+            print("==> [{}] Build failed: {}".format(tag, e))
+            raise
+
+    built, failed = schedule(dependencies, build_entry, args.jobs)
+
+    print("==> Built {} of {} images".format(len(built), len(entries)))
+    for tag, reason in sorted(failed.items()):
+        print("  -> {}: {}".format(tag, reason))
+    if failed:
+        sys.exit(1)
+
+
+def compressor_cmd(compression, threads=0):
+    """Command line of a streaming compressor writing to stdout
+
+    threads=0 lets the compressor use all cores. gzip uses pigz when it is
+    installed and falls back to single threaded gzip.
+    """
+    if compression == "gz":
+        if shutil.which("pigz"):
+            return ["pigz", "-c"] + (["-p", str(threads)] if threads else [])
+        return ["gzip", "-c"]
+    elif compression == "zst":
+        return ["zstd", "-q", "-c", "-T{}".format(threads)]
+    elif compression:
+        raise NotImplementedError("Unknown compression {}".format(compression))
+
+
+def stream_export(cmd, output, compression=None, threads=0):
+    """Pipe stdout of cmd through an optional compressor into output
+
+    output "-" streams to stdout, nothing is staged on disk.
+    """
+    out = sys.stdout.buffer if output == "-" else open(output, "wb")
+    try:
+        compressor = compressor_cmd(compression, threads)
+        producer = subprocess.Popen(cmd, stdout=subprocess.PIPE if compressor else out)
+        if compressor:
+            compress = subprocess.run(compressor, stdin=producer.stdout, stdout=out)
+            producer.stdout.close()
+        producer.wait()
+        if producer.returncode:
+            raise subprocess.CalledProcessError(producer.returncode, cmd)
+        if compressor and compress.returncode:
+            raise subprocess.CalledProcessError(compress.returncode, compressor)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+
+
+def squashfs_options(comp=None, block_size=None):
+    """mksquashfs options that decide the contents of the image"""
+    options = ['-no-xattrs', '-noappend']
+    if comp:
+        options.extend(('-comp', comp))
+    if block_size:
+        options.extend(('-b', str(parse_size(block_size))))
+    return options
+
+
+def export_squashfs(r, image, output, args, log):
+    """Export image as squashfs, reusing an earlier export with the same options
+
+    Sealed images never change, so exports are cached in the runtime dir
+    keyed by image hash and mksquashfs options.
+    """
+    options = squashfs_options(args.comp, args.block_size)
+    cache = r.runtime / export_cache_name
+    cache.mkdir(exist_ok=True)
+    artifact = cache / "{}-{}.squashfs".format(image, sha256(" ".join(options).encode()).hexdigest()[:16])
+
+    if args.no_cache or not artifact.exists():
+        print("  -> Building squashfs image with {}".format(" ".join(options)), file=log)
+        tmp = cache / "{}.tmp-{}".format(artifact.name, os.getpid())
+        cmd = ['mksquashfs', str(r.runtime / image), str(tmp)] + options
+        if args.threads:
+            cmd.extend(('-processors', str(args.threads)))
+        start = time.perf_counter()
+        try:
+            subprocess.run(cmd, check=True, stdout=log)
+            os.replace(str(tmp), str(artifact))
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+        elapsed = time.perf_counter() - start
+        size = r.image_size(image)
+        print("  -> Compressed {} into {} in {:.2f}s, {}/s".format(
+            format_size(size), format_size(artifact.stat().st_size), elapsed,
+            format_size(size / max(elapsed, 1e-6))), file=log)
+    else:
+        print("  -> Using cached export {}".format(artifact.name), file=log)
+
+    print("  -> Writing squashfs image to " + output, file=log)
+    start = time.perf_counter()
+    size = artifact.stat().st_size
+    if output == "-":
+        with artifact.open("rb") as f:
+            shutil.copyfileobj(f, sys.stdout.buffer, 1 << 20)
+        sys.stdout.buffer.flush()
+        reflinked = False
+    else:
+        reflinked = copy_file_data(str(artifact), output, size)
+    elapsed = time.perf_counter() - start
+    print("  -> Wrote {} in {:.2f}s{}".format(
+        format_size(size), elapsed, ", reflinked" if reflinked else
+        ", {}/s".format(format_size(size / max(elapsed, 1e-6)))), file=log)
 
 
 def export(args):
     runtime = Path(args.runtime).resolve()
-    r = ImageStorage(runtime)
+    r = open_storage(runtime)
     image = r.find_last_build_by_name(args.container)
+    output = args.output
+    if output is None:
+        output = str(args.container) + "." + args.type
+    #  Keep stdout clean when the image itself is streamed there
+    log = sys.stderr if output == "-" else sys.stdout
 
     if not image:
         raise Exception('Can\'t find container image with name "{}"'.format(args.container))
-    print('==> Exporting image "{}" with hash {}'.format(args.container, image[:16]))
+    print('==> Exporting image "{}" with hash {}'.format(args.container, image[:16]), file=log)
+
+    kind, _, compression = args.type.partition(".")
+    if args.incremental and kind != "btrfs":
+        raise ValueError("Incremental export needs a btrfs export type")
 
     if args.type == "squashfs":
-        output = str(args.container) + ".squashfs" if args.output is None else args.output
-        print("  -> Building squashfs image "+output)
-        subprocess.run(('mksquashfs', str(runtime / image), output, '-no-xattrs', '-noappend'))
+        export_squashfs(r, image, output, args, log)
+    elif kind == "tar":
+        print("  -> Streaming tar archive to " + output, file=log)
+        stream_export(
+            ('tar', '-C', str(runtime / image), '--numeric-owner', '--xattrs',
+             '--xattrs-exclude=user.parent_hash', '--xattrs-exclude=user.cmd.*', '-cf', '-', '.'),
+            output, compression, args.threads)
+    elif kind == "btrfs":
+        cmd = ['btrfs', 'send', '-q']
+        if args.incremental:
+            if args.parent:
+                parent = r.find_last_build_by_name(args.parent) or args.parent
+            else:
+                parent = (r.get(image) or {}).get("parent_hash")
+            if parent:
+                if not (runtime / parent).exists():
+                    raise FileNotFoundError("Parent image {} not found".format(parent))
+                if not btrfs_subvol_is_readonly(runtime / parent):
+                    raise ValueError("Parent image {} is not a sealed readonly image".format(parent))
+                print("  -> Sending changes since parent image {}".format(parent[:16]), file=log)
+                cmd.extend(('-p', str(runtime / parent)))
+        print("  -> Streaming btrfs send stream to " + output, file=log)
+        with readonly_subvolume(runtime / image) as source:
+            stream_export(cmd + [str(source)], output, compression, args.threads)
     else:
         raise NotImplementedError("Can't yet export container image with type {}".format(args.type))
 
 
+import_types = {
+    ".squashfs": "squashfs",
+    ".sqsh": "squashfs",
+    ".tar": "tar",
+    ".tar.gz": "tar.gz",
+    ".tgz": "tar.gz",
+    ".tar.zst": "tar.zst",
+    ".tzst": "tar.zst",
+}
+
+
+def import_type(filename):
+    """Returns (suffix, type) of an image file name, type is None if unknown"""
+    for suffix in sorted(import_types, key=len, reverse=True):
+        if filename.endswith(suffix):
+            return suffix, import_types[suffix]
+    return os.path.splitext(filename)[1], None
+
+
+def decompressor_cmd(compression, threads=0):
+    if compression == "gz":
+        return ["pigz", "-dc"] if shutil.which("pigz") else ["gzip", "-dc"]
+    elif compression == "zst":
+        return ["zstd", "-q", "-dc", "-T{}".format(threads)]
+    elif compression:
+        raise NotImplementedError("Unknown compression {}".format(compression))
+
+
+def stream_import(source, path, compression=None):
+    """Unpack a tar stream from the binary file object source into path
+
+    Returns sha256 hex digest of the archive as it was read.
+    """
+    digest = sha256()
+    decompressor = decompressor_cmd(compression)
+    tar_cmd = ('tar', '-C', str(path), '--numeric-owner', '--xattrs', '--xattrs-include=*', '-xf', '-')
+    if decompressor:
+        decompress = subprocess.Popen(decompressor, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        tar = subprocess.Popen(tar_cmd, stdin=decompress.stdout)
+        decompress.stdout.close()
+        sink, processes = decompress.stdin, (decompress, tar)
+    else:
+        tar = subprocess.Popen(tar_cmd, stdin=subprocess.PIPE)
+        sink, processes = tar.stdin, (tar,)
+    try:
+        for chunk in iter(lambda: source.read(1 << 20), b""):
+            digest.update(chunk)
+            sink.write(chunk)
+    finally:
+        sink.close()
+        for process in processes:
+            process.wait()
+    for process in processes:
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+    return digest.hexdigest()
+
+
 def image_import(args):
     runtime = Path(args.runtime).resolve()
-    r = ImageStorage(runtime)
-    name = args.tag if args.tag else os.path.splitext(args.image)[0]
+    r = open_storage(runtime)
+    suffix, kind = import_type(args.image)
+    kind = args.type or kind
+    if args.image == "-" and not args.tag:
+        raise ValueError("Importing from stdin needs a --tag")
+    name = args.tag if args.tag else os.path.basename(args.image)[:-len(suffix) or None]
     image = r.find_last_build_by_name(name)
     if image:
         raise Exception('Container image with name "{}" already exists'.format(name))
+    if kind is None:
+        raise NotImplementedError("Can't yet import container image with type {}".format(suffix))
+
+    #  Identical archives are only unpacked once, later imports just get tagged.
+    #  Archives are only read once, the digest is calculated while unpacking
+    #  unless an earlier import already knows it.
+    digest = None
+    if args.image != "-":
+        file_hashes = FileHashIndex(runtime / metadata_db_name)
+        source = Path(args.image).resolve()
+        source_st = source.stat()
+        digest = file_hashes.cached_digest(source, source_st)
+        existing = r.find_image_by_attr("import_digest", digest)
+        if existing:
+            print('==> Image "{}" was already imported as {}'.format(args.image, existing))
+            r.tag(name, existing)
+            print('==> Tagged subvolume {} as "{}"'.format(existing, name))
+            return
 
     path = "imported-image-" + name
     path = str(runtime / path)
     if (os.path.isdir(path)):
         raise Exception('Target directory {} already exists. Please remove before importing'.format(path))
 
-    extension = os.path.splitext(args.image)[1]
-    if(extension == ".squashfs" or extension == ".sqsh"):
-        print('==> Exporting image "{}" to {}'.format(args.image, path))
-        btrfs_subvol_create(path)
-        subprocess.run(("unsquashfs", "-f", "-d", path, args.image))
+    print('==> Importing image "{}" to {}'.format(args.image, path))
+    btrfs_subvol_create(path)
+    try:
+        if kind == "squashfs":
+            if args.image == "-":
+                raise NotImplementedError("Can't import squashfs images from stdin")
+            subprocess.run(("unsquashfs", "-f", "-d", path, args.image), check=True)
+            if digest is None:
+                digest = file_hashes.file_digest(source, source_st)
+        else:
+            compression = kind.partition(".")[2]
+            if args.image == "-":
+                digest = stream_import(sys.stdin.buffer, path, compression)
+            else:
+                with open(args.image, "rb") as f:
+                    digest = stream_import(f, path, compression)
+                file_hashes.store(source, source_st, digest)
+    except BaseException:
+        btrfs_subvol_delete(path)
+        raise
+    if args.image != "-":
+        file_hashes.commit()
+
+    existing = r.find_image_by_attr("import_digest", digest)
+    if existing:
+        print("  -> Same content as {}, dropping the new copy".format(existing))
+        btrfs_subvol_delete(path)
+        path = str(runtime / existing)
     else:
-        raise NotImplementedError("Can't yet import container image with type {}".format(extension))
-
+        os.setxattr(path, b"user.import_digest", digest.encode())
+        r.add_image(os.path.basename(path), {"import_digest": digest})
     print('==> Tagging subvolume {} as "{}"'.format(path, name))
-    tag = "tag-" + name
-    os.symlink(path, str(runtime / tag))
+    r.tag(name, os.path.basename(path))
+
+
+class DirectoryRegistry():
+    """Image registry kept in a plain directory
+
+    layers/NAME.btrfs holds a btrfs send stream of a layer, relative to
+    its parent layer when the parent is a sealed readonly layer, and
+    layers/NAME.json its metadata. Incremental layers also keep a full
+    stream in layers/NAME.full.btrfs for receivers whose copy of the
+    parent did not come from the same sender. tags/TAG contains the name
+    of the image the tag points to.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        (self.path / "layers").mkdir(parents=True, exist_ok=True)
+        (self.path / "tags").mkdir(parents=True, exist_ok=True)
+
+    def has_layer(self, name):
+        return (self.path / "layers" / (name + ".json")).exists()
+
+    def layer_stream(self, name):
+        return self.path / "layers" / (name + ".btrfs")
+
+    def layer_meta(self, name):
+        with (self.path / "layers" / (name + ".json")).open() as f:
+            return json.load(f)
+
+    def full_stream(self, name):
+        return self.path / "layers" / (name + ".full.btrfs")
+
+    def receive_stream(self, name, parent_uuids):
+        """Stream to receive layer name given the UUIDs of the local copy of its parent"""
+        parent_uuid = self.layer_meta(name).get("parent_uuid")
+        if parent_uuid is None or parent_uuid in parent_uuids or not self.full_stream(name).exists():
+            return self.layer_stream(name)
+        return self.full_stream(name)
+
+    def put_layer(self, name, meta, send_cmd, full_cmd=None):
+        """Store the output of send_cmd as layer name, the metadata is written last
+
+        full_cmd gives the full stream of an incremental layer.
+        """
+        for cmd, stream in ((send_cmd, self.layer_stream(name)), (full_cmd, self.full_stream(name))):
+            if cmd is None:
+                continue
+            tmp = stream.with_name(stream.name + ".tmp")
+            with tmp.open("wb") as f:
+                subprocess.run(cmd, stdout=f, check=True)
+            os.replace(str(tmp), str(stream))
+        meta_path = self.path / "layers" / (name + ".json")
+        with meta_path.with_name(meta_path.name + ".tmp").open("w") as f:
+            json.dump(meta, f)
+        os.replace(str(meta_path) + ".tmp", str(meta_path))
+
+    def get_tag(self, tag):
+        path = self.path / "tags" / tag
+        if not path.exists():
+            raise FileNotFoundError('Tag "{}" not found in registry {}'.format(tag, self.path))
+        return path.read_text().strip()
+
+    def set_tag(self, tag, image):
+        path = self.path / "tags" / tag
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(image + "\n")
+        os.replace(str(tmp), str(path))
+
+    def chain(self, image):
+        """Layers from the root layer up to image"""
+        layers = []
+        while image:
+            layers.append(image)
+            image = self.layer_meta(image).get("parent_hash")
+        return layers[::-1]
+
+
+def image_chain(r, image):
+    """Local layers from the root layer up to image"""
+    layers = []
+    while image:
+        layers.append(image)
+        image = (r.get(image) or {}).get("parent_hash")
+    return layers[::-1]
+
+
+def push(args):
+    runtime = Path(args.runtime).resolve()
+    r = open_storage(runtime)
+    registry = DirectoryRegistry(args.registry)
+    image = r.find_last_build_by_name(args.container)
+    if not image:
+        raise FileNotFoundError('Can\'t find container image with name "{}"'.format(args.container))
+
+    layers = image_chain(r, image)
+    missing = [layer for layer in layers if not registry.has_layer(layer)]
+    print('==> Pushing "{}" ({} layers, {} missing in registry)'.format(args.container, len(layers), len(missing)))
+    for layer in missing:
+        attrs = r.get(layer) or {}
+        parent = attrs.get("parent_hash")
+        with readonly_subvolume(runtime / layer) as source:
+            meta = {"parent_hash": parent, "subvolume": source.name, "attrs": attrs}
+            send_cmd = ['btrfs', 'send', '-q']
+            full_cmd = None
+            if parent and btrfs_subvol_is_readonly(runtime / parent):
+                #  Receivers need a parent with this UUID, the full stream serves the others
+                uuid, received_uuid = btrfs_subvol_uuids(runtime / parent)
+                meta["parent_uuid"] = received_uuid or uuid
+                full_cmd = send_cmd + [str(source)]
+                send_cmd = send_cmd + ['-p', str(runtime / parent)]
+                print("  -> Sending {} relative to {}".format(layer[:16], parent[:16]))
+            else:
+                print("  -> Sending {}".format(layer[:16]))
+            send_cmd.append(str(source))
+            registry.put_layer(layer, meta, send_cmd, full_cmd)
+    registry.set_tag(args.container, image)
+    print('==> Pushed "{}" as {}'.format(args.container, image[:16]))
+
+
+def pull(args):
+    runtime = Path(args.runtime).resolve()
+    r = open_storage(runtime)
+    registry = DirectoryRegistry(args.registry)
+    image = registry.get_tag(args.container)
+
+    layers = registry.chain(image)
+    missing = [layer for layer in layers if not (runtime / layer).exists()]
+    print('==> Pulling "{}" ({} layers, {} missing locally)'.format(args.container, len(layers), len(missing)))
+    receive_dir = runtime / ".receive"
+    receive_dir.mkdir(exist_ok=True)
+    for layer in missing:
+        meta = registry.layer_meta(layer)
+        parent_uuids = ()
+        if meta.get("parent_uuid"):
+            parent_uuids = btrfs_subvol_uuids(runtime / meta["parent_hash"])
+        stream = registry.receive_stream(layer, parent_uuids)
+        if stream == registry.full_stream(layer):
+            print("  -> Receiving {} in full, the local parent was not received from this registry".format(layer[:16]))
+        else:
+            print("  -> Receiving {}".format(layer[:16]))
+        try:
+            subprocess.run(('btrfs', 'receive', '-q', '-f', str(stream), str(receive_dir)), check=True)
+        except subprocess.CalledProcessError:
+            if (receive_dir / meta["subvolume"]).exists():
+                btrfs_subvol_delete(receive_dir / meta["subvolume"])
+            raise
+        os.rename(str(receive_dir / meta["subvolume"]), str(runtime / layer))
+        r.add_image(layer, meta["attrs"])
+    r.tag(args.container, image)
+    print('==> Tagged image {} as {}'.format(image[:16], args.container))
+
+
+def parse_volume(volume):
+    """Turn a SRC[:DEST] volume into a systemd-nspawn --bind argument"""
+    src_dest = volume.split(':')
+    if len(src_dest) > 1:
+        src = src_dest[0]
+        dest = ":".join(src_dest[1:])
+    else:
+        src = src_dest[0]
+        dest = ''
+    src = Path(src)
+    if not src.exists():
+        raise FileNotFoundError("Volume {} does not exist".format(src))
+    if not src.is_absolute():
+        src = src.resolve()
+    if not dest:
+        dest = '/' + src.name
+    if not dest.startswith('/'):
+        dest = '/' + dest
+    return "{}:{}".format(src, dest)
+
+
+class SnapshotPool():
+    """Writable snapshots of an image, created ahead of use by a background thread
+
+    At most size snapshots wait ready in the pool, total are created in all.
+    """
+
+    def __init__(self, image, directory, size, total):
+        self.image = Path(image)
+        self.directory = Path(directory)
+        self.ready = queue.Queue(maxsize=size)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._fill, args=(total,), daemon=True)
+        self.thread.start()
+
+    def _fill(self, total):
+        for number in range(total):
+            if self.stopped.is_set():
+                return
+            path = self.directory / "{}-{}-{}".format(self.image.name[:16], os.getpid(), number)
+            try:
+                btrfs_subvol_snapshot(self.image, path)
+            except Exception as e:
+                self.ready.put(e)
+                return
+            self.ready.put(path)  # blocks while the pool is full
+
+    def get(self):
+        item = self.ready.get()
+        if isinstance(item, Exception):
+            self.ready.put(item)  # fail the other waiters too
+            raise item
+        return item
+
+    def close(self):
+        """Stop filling and delete the snapshots nobody took"""
+        self.stopped.set()
+        leftovers = []
+        while self.thread.is_alive() or not self.ready.empty():
+            try:
+                item = self.ready.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if isinstance(item, Path):
+                leftovers.append(item)
+        btrfs_subvol_delete_many(leftovers)
+
+
+def run_batch(target, env, commands, args):
+    """Run commands concurrently, each in its own throwaway snapshot of target
+
+    Returns a list of (exit code, seconds) per command.
+    """
+    directory = target.parent / ".run"
+    directory.mkdir(exist_ok=True)
+    options = ['--bind=' + parse_volume(volume) for volume in args.volume or ()]
+    results = [None] * len(commands)
+    print("==> Running {} jobs, {} at a time".format(len(commands), args.jobs))
+
+    def job(index):
+        snapshot = pool.get()
+        start = time.perf_counter()
+        try:
+            proc = nspawn_run(snapshot, commands[index], env=env, options=options,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        finally:
+            btrfs_subvol_delete(snapshot)
+        results[index] = (proc.returncode, time.perf_counter() - start)
+        status = "ok" if proc.returncode == 0 else "exit {}".format(proc.returncode)
+        output = "" if proc.returncode == 0 else "".join(
+            "     " + line for line in proc.stdout.decode(errors="replace").splitlines(True))
+        print("  -> [{}/{}] {} in {:.2f}s: {}\n{}".format(
+            index + 1, len(commands), status, results[index][1], commands[index], output), end="")
+
+    pool = SnapshotPool(target, directory, args.pool or args.jobs, len(commands))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+            for future in [executor.submit(job, index) for index in range(len(commands))]:
+                future.result()
+    finally:
+        pool.close()
+    return results
+
+
+def load_batch(batch):
+    """Commands of a batch file, one per line, '-' reads them from stdin"""
+    f = sys.stdin if batch == "-" else open(batch)
+    try:
+        lines = [line.strip() for line in f]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return [line for line in lines if line and not line.startswith("#")]
 
 
 def run(args):
     runtime = Path(args.runtime).resolve()
-    r = ImageStorage(runtime)
+    r = open_storage(runtime)
     df = None
 
     target = r.find_last_build_by_name(args.container)
@@ -371,16 +2647,8 @@ def run(args):
 
         df = DockerfileParser(dockerfile)
 
-        #  Locate base image for this Dockerfile
-        parent_hash = ""
-        if df.from_image != "scratch":
-            parent_hash = r.find_last_build_by_name(df.from_image)
-            if not parent_hash:
-                raise FileNotFoundError("Image with name {} not found".format(df.from_image))
-            print("Using parent image {}".format(parent_hash[:16]))
-
-        #  Update build hashes based on base image
-        df.calc_build_hashes(parent_hash=parent_hash)
+        #  Update build hashes based on base images and COPY sources
+        resolve_build_hashes(r, df, context)
 
         target = runtime / df.build_hashes[-1]
         if not target.exists():
@@ -388,62 +2656,558 @@ def run(args):
 
     else:
         print(target)
+        r.touch(target)
         target = runtime / target
         if not target.exists():
             raise FileNotFoundError("Image {} not found".format(args.container))
 
+    if args.batch:
+        commands = load_batch(args.batch)
+        start = time.perf_counter()
+        results = run_batch(target, df.env if df else {}, commands, args)
+        failed = [index for index, (code, duration) in enumerate(results) if code]
+        durations = sorted(duration for code, duration in results)
+        print("==> Ran {} jobs in {:.2f}s, {} passed, {} failed".format(
+            len(results), time.perf_counter() - start, len(results) - len(failed), len(failed)))
+        if durations:
+            print("  -> Job time min {:.2f}s, median {:.2f}s, max {:.2f}s".format(
+                durations[0], durations[len(durations) // 2], durations[-1]))
+        for index in failed:
+            print("  -> Failed [{}/{}] exit {}: {}".format(index + 1, len(results), results[index][0], commands[index]))
+        if failed:
+            sys.exit(1)
+        return
+
     print('  -> RUN {}'.format(args.command))
-    nspawn_cmd = nspawn_cmd_base.copy()
-    if df:
-        for key, val in df.env.items():
-            nspawn_cmd.extend(('--setenv', '{}={}'.format(key, val)))
+    options = []
     if args.rm:
-        nspawn_cmd.append('-x')
-    if args.volume:
-        src_dest = args.volume.split(':')
-        if len(src_dest) > 1:
-            src = src_dest[0]
-            dest = ":".join(src_dest[1:])
-        else:
-            src = src_dest[0]
-            dest = ''
-        src = Path(src)
-        if not src.exists():
-            raise FileNotFoundError("Volume {} does not exist".format(src))
-        if not src.is_absolute():
-            src = src.resolve()
-        if not dest:
-            dest = '/' + src.name
-        if not dest.startswith('/'):
-            dest = '/' + dest
-        volume = "{}:{}".format(src, dest)
-        nspawn_cmd.append('--bind=' + str(volume))
-    nspawn_cmd.extend(('--register=no', '-D', str(target), '/bin/sh', '-c', args.command))
-    subprocess.run(nspawn_cmd, cwd=str(target), check=True, shell=False, env=df.env if df else {})
+        options.append('-x')
+    for volume in args.volume or ():
+        options.append('--bind=' + parse_volume(volume))
+    nspawn_run(target, args.command, env=df.env if df else {}, options=options, check=True)
+
+
+def parse_size(size):
+    """Parse sizes like 512M or 20G into bytes"""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    size = size.strip().upper().rstrip("IB")
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def parse_duration(duration):
+    """Parse durations like 90s, 30m, 12h or 7d into seconds"""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+    duration = duration.strip().lower()
+    if duration[-1:] in units:
+        return float(duration[:-1]) * units[duration[-1]]
+    return float(duration)
+
+
+def gc_plan(r, max_size=None, max_age=None, now=None):
+    """Choose unreachable images to evict, least recently used leaves first
+
+    An image only becomes a candidate once all its children are evicted,
+    its size is estimated as the bytes it adds on top of its parent.
+    Returns the list of images to delete and the estimated bytes freed.
+    """
+    now = time.time() if now is None else now
+    reachable = r.reachable()
+    rows = r.db.execute("SELECT name, parent_hash, last_used FROM images").fetchall()
+    parents = {name: parent for name, parent, last_used in rows}
+    last_used = {name: used or 0 for name, parent, used in rows}
+    children = {}
+    for name, parent in parents.items():
+        children.setdefault(parent, set()).add(name)
+
+    def layer_size(name):
+        size = r.image_size(name)
+        parent = parents.get(name)
+        if parent in parents:
+            size -= r.image_size(parent)
+        return max(size, 0)
+
+    total = sum(layer_size(name) for name in parents) if max_size is not None else 0
+    heap = [(last_used[name], name) for name in parents
+            if name not in reachable and not children.get(name) and not name.endswith("-init")]
+    heapq.heapify(heap)
+
+    evict, freed = [], 0
+    while heap:
+        used, name = heapq.heappop(heap)
+        too_old = max_age is not None and now - used > max_age
+        too_big = max_size is not None and total - freed > max_size
+        if not too_old and not too_big:
+            break  # LRU order, everything left is newer
+        evict.append(name)
+        freed += layer_size(name)
+        parent = parents.get(name)
+        siblings = children.get(parent, set())
+        siblings.discard(name)
+        if parent in parents and not siblings and parent not in reachable:
+            heapq.heappush(heap, (last_used[parent], parent))
+    return evict, freed
+
+
+def gc(args):
+    runtime = Path(args.runtime).resolve()
+    r = open_storage(runtime)
+    max_size = parse_size(args.max_size) if args.max_size else None
+    max_age = parse_duration(args.max_age) if args.max_age else None
+    if max_size is None and max_age is None:
+        max_age = 0  # Nothing to keep but tagged images
+
+    evict, freed = gc_plan(r, max_size=max_size, max_age=max_age)
+    print("==> Evicting {} unreachable images, about {}".format(len(evict), format_size(freed)))
+    keep = set()  # parents of skipped images stay as well
+    for start in range(0, len(evict), args.batch):
+        batch = []
+        locks = []
+        for image in evict[start:start + args.batch]:
+            lock = StepLock(runtime, image)
+            if image in keep or not lock.acquire(blocking=False):
+                print("  -> Skipping {}, it is in use by a builder".format(image[:16]))
+                keep.add((r.get(image) or {}).get("parent_hash"))
+                continue
+            print("  -> Removing {}".format(image[:16]))
+            batch.append(image)
+            locks.append(lock)
+        try:
+            if args.dry_run:
+                continue
+            btrfs_subvol_delete_many((runtime / image for image in batch), commit=True)
+            for image in batch:
+                r.remove_image(image)
+        finally:
+            for lock in locks:
+                lock.release()
 
 
 def wipe(args):
     runtime = Path(args.runtime).resolve()
-    r = ImageStorage(runtime)
-    print("==> Removing {} images from runtime store".format(len(r.images)))
-    for image in r.images.keys():
+    r = open_storage(runtime)
+    images = r.reindex()
+    print("==> Removing {} images from runtime store".format(len(images)))
+    subvolumes = []
+    for image in images.keys():
         print("  -> Removing {}".format(image[:16]))
         if image.startswith('tag'):
-            os.unlink(str(runtime / image))
+            r.untag(image[4:])
         else:
-            btrfs_subvol_delete(str(runtime / image))
+            subvolumes.append(runtime / image)
+    btrfs_subvol_delete_many(subvolumes, commit=True)
+    for subvolume in subvolumes:
+        r.remove_image(subvolume.name)
+
+
+def reindex(args):
+    runtime = Path(args.runtime).resolve()
+    r = open_storage(runtime)
+    print("==> Reindexing runtime store {}".format(runtime))
+    images = r.reindex()
+    tags = [name for name in images if name.startswith("tag-")]
+    print("  -> Indexed {} images and {} tags".format(len(images) - len(tags), len(tags)))
+
+
+def cache_tree(args):
+    runtime = Path(args.runtime).resolve()
+    r = open_storage(runtime)
+    parents = r.parents()
+    children = {}
+    for name, parent_hash in parents.items():
+        if parent_hash not in parents:
+            parent_hash = ""  # root layer, or its parent is gone
+        children.setdefault(parent_hash, []).append(name)
+
+    #  Count for every layer how many tags share it through their chains
+    tags = r.tags()
+    tag_names = {}
+    users = {}
+    referenced = 0
+    for tag, image in sorted(tags.items()):
+        tag_names.setdefault(image, []).append(tag)
+        while image in parents:
+            users[image] = users.get(image, 0) + 1
+            referenced += 1
+            image = parents[image]
+
+    print("==> Layer tree of {}, {} layers, {} tags".format(runtime, len(parents), len(tags)))
+
+    def walk(name, prefix, last):
+        attrs = r.get(name) or {}
+        cmd = next((key for key in attrs if key.startswith("cmd.")), None)
+        desc = "{} {}".format(cmd[4:].upper(), attrs[cmd]) if cmd else "IMPORT"
+        if len(desc) > 48:
+            desc = desc[:45] + "..."
+        line = "{}{}{} {:<48} {}".format(
+            prefix, "└── " if last else "├── ", name[:16], desc,
+            "used by {}".format(users[name]) if name in users else "untagged")
+        if name in tag_names:
+            line += " [{}]".format(", ".join(tag_names[name]))
+        print(line)
+        below = sorted(children.get(name, []))
+        for i, child in enumerate(below):
+            walk(child, prefix + ("    " if last else "│   "), i == len(below) - 1)
+
+    roots = sorted(children.get("", []))
+    for i, root in enumerate(roots):
+        walk(root, "", i == len(roots) - 1)
+
+    if referenced:
+        shared = referenced - len(users)
+        print("==> Tags reference {} layers stored as {}, {} ({:.0f}%) reused through shared prefixes".format(
+            referenced, len(users), shared, shared * 100 / referenced))
+
+
+def disk_usage(r, method="auto", jobs=None):
+    """Referenced and exclusive bytes of every layer and tag
+
+    Uses btrfs qgroups when quotas are enabled, otherwise walks the
+    extents of every layer in parallel. With qgroups the exclusive bytes
+    of a tag only count layers no other tag uses.
+    """
+    runtime = r.runtime
+    parents = r.parents()
+    layers = sorted(name for name in parents if not name.endswith("-init") and (runtime / name).exists())
+    chains = {}
+    for tag, image in r.tags().items():
+        chain = chains[tag] = set()
+        while image in parents and image not in chain:
+            chain.add(image)
+            image = parents[image]
+    layer_tags = {name: sorted(tag for tag, chain in chains.items() if name in chain) for name in layers}
+
+    qgroups = btrfs_qgroups(runtime) if method != "walk" else None
+    if method == "qgroups" and qgroups is None:
+        raise RuntimeError("btrfs quotas are not enabled on {}".format(runtime))
+    usage = {"method": "qgroups" if qgroups is not None else "walk", "layers": [], "tags": []}
+
+    layer_usage = {}
+    tag_exclusive = {tag: 0 for tag in chains}
+    if qgroups is not None:
+        for name in layers:
+            layer_usage[name] = qgroups.get(btrfs_subvol_id(runtime / name), (0, 0))
+            if len(layer_tags[name]) == 1:
+                tag_exclusive[layer_tags[name][0]] += layer_usage[name][1]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            extents = dict(zip(layers, pool.map(r.image_extents, layers)))
+        owners = {}
+        inline = {}
+        for name, (referenced, layer_extents) in extents.items():
+            inline[name] = referenced - sum(length for physical, length in layer_extents)
+            for extent in layer_extents:
+                owners.setdefault(extent, set()).add(name)
+        for name, (referenced, layer_extents) in extents.items():
+            shared = sum(length for physical, length in layer_extents if len(owners[physical, length]) > 1)
+            layer_usage[name] = (referenced, referenced - shared)
+            if len(layer_tags[name]) == 1:
+                #  Inline data is never shared, it belongs to the only tag using the layer
+                tag_exclusive[layer_tags[name][0]] += inline[name]
+        for (physical, length), names in owners.items():
+            tags = {tag for name in names for tag in layer_tags[name] or [None]}
+            if len(tags) == 1 and None not in tags:
+                tag_exclusive[tags.pop()] += length
+        usage["total"] = sum(length for physical, length in owners) + sum(inline.values())
+
+    for name in layers:
+        attrs = r.get(name) or {}
+        cmd = next((key for key in attrs if key.startswith("cmd.")), None)
+        usage["layers"].append({
+            "image": name, "parent_hash": parents[name] or None,
+            "cmd": cmd[4:] if cmd else None, "args": attrs[cmd] if cmd else None,
+            "tags": layer_tags[name],
+            "referenced": layer_usage[name][0], "exclusive": layer_usage[name][1],
+        })
+    for tag, image in sorted(r.tags().items()):
+        usage["tags"].append({
+            "tag": tag, "image": image,
+            "referenced": layer_usage.get(image, (0, 0))[0], "exclusive": tag_exclusive.get(tag, 0),
+        })
+    return usage
+
+
+def du(args):
+    runtime = Path(args.runtime).resolve()
+    r = open_storage(runtime)
+    usage = disk_usage(r, method=args.method, jobs=args.jobs)
+    if args.json:
+        print(json.dumps(usage, indent=2))
+        return
+
+    print("==> Disk usage of {} from {}".format(runtime, usage["method"]))
+    print("  {:16} {:16} {:32} {:>10} {:>10}  {}".format("IMAGE", "PARENT", "CMD", "REFERENCED", "EXCLUSIVE", "TAGS"))
+    for layer in usage["layers"]:
+        cmd = "{} {}".format(layer["cmd"].upper(), layer["args"]) if layer["cmd"] else "IMPORT"
+        if len(cmd) > 32:
+            cmd = cmd[:29] + "..."
+        print("  {:16} {:16} {:32} {:>10} {:>10}  {}".format(
+            layer["image"][:16], (layer["parent_hash"] or "-")[:16], cmd,
+            format_size(layer["referenced"]), format_size(layer["exclusive"]), ", ".join(layer["tags"])))
+    if usage["tags"]:
+        print("==> Tags")
+        print("  {:32} {:16} {:>10} {:>10}".format("TAG", "IMAGE", "REFERENCED", "EXCLUSIVE"))
+        for tag in usage["tags"]:
+            print("  {:32} {:16} {:>10} {:>10}".format(
+                tag["tag"], tag["image"][:16], format_size(tag["referenced"]), format_size(tag["exclusive"])))
+    if "total" in usage:
+        print("==> {} layers use {} on disk".format(len(usage["layers"]), format_size(usage["total"])))
+
+
+def dedupe_plan(r, min_size=4096, file_hashes=None):
+    """Groups of identical files across sealed images
+
+    Files are grouped by size first and only same sized files are hashed,
+    with digests cached in file_hashes. Files that already share all their
+    extents count once. Returns a list of (size, paths) where the first
+    path is the one to share extents from.
+    """
+    if file_hashes is None:
+        file_hashes = FileHashIndex()
+    by_size = {}
+    for name in sorted(r.parents()):
+        image = r.runtime / name
+        if name.endswith("-init") or not image.exists():
+            continue
+        for root, dirs, files in os.walk(str(image)):
+            dirs.sort()
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode) and st.st_size >= min_size:
+                    by_size.setdefault(st.st_size, []).append((path, st))
+
+    groups = []
+    for size, candidates in sorted(by_size.items()):
+        if len(candidates) < 2:
+            continue
+        by_digest = {}
+        layouts = set()
+        inodes = set()
+        for path, st in candidates:
+            if (st.st_dev, st.st_ino) in inodes:
+                continue  # hard link
+            inodes.add((st.st_dev, st.st_ino))
+            fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+            try:
+                layout = tuple(file_extents(fd, size))
+            except OSError:
+                layout = None
+            finally:
+                os.close(fd)
+            if layout and (size, layout) in layouts:
+                continue  # already shares every extent with a file we have seen
+            layouts.add((size, layout))
+            by_digest.setdefault(file_hashes.file_digest(path, st), []).append(path)
+        groups.extend((size, paths) for paths in by_digest.values() if len(paths) > 1)
+    return groups
+
+
+def dedupe_targets(runtime, groups, received=()):
+    """Dict of images and the (src, dest, size) files to dedupe into them
+
+    A file of a received image is preferred as the source of a group,
+    received images are never a destination.
+    """
+    by_image = {}
+    for size, paths in groups:
+        image_of = {path: Path(path).relative_to(runtime).parts[0] for path in paths}
+        paths = sorted(paths, key=lambda path: image_of[path] not in received)
+        for path in paths[1:]:
+            if image_of[path] not in received:
+                by_image.setdefault(image_of[path], []).append((paths[0], path, size))
+    return by_image
+
+
+def dedupe(args):
+    runtime = Path(args.runtime).resolve()
+    r = open_storage(runtime)
+    file_hashes = FileHashIndex(runtime / metadata_db_name)
+    print("==> Looking for identical files in {}".format(runtime))
+    groups = dedupe_plan(r, parse_size(args.min_size), file_hashes)
+    file_hashes.commit()
+
+    #  Images that came from btrfs receive are never targets, clearing their
+    #  readonly flag may drop the received UUID that incremental pulls need
+    received = set()
+    for name in {Path(path).relative_to(runtime).parts[0] for size, paths in groups for path in paths}:
+        try:
+            if btrfs_subvol_uuids(runtime / name)[1]:
+                received.add(name)
+        except (OSError, subprocess.CalledProcessError):
+            pass  # not a btrfs subvolume
+    by_image = dedupe_targets(runtime, groups, received)
+    expected = sum(size for pairs in by_image.values() for src, dest, size in pairs)
+    print("  -> {} files in {} groups are identical, about {} can be shared".format(
+        sum(len(paths) for size, paths in groups), len(groups), format_size(expected)))
+    if received:
+        print("  -> Not changing {} received images".format(len(received)))
+    if args.dry_run:
+        for size, paths in groups:
+            print("  -> {} x{}: {}".format(format_size(size), len(paths), paths[0]))
+        return
+
+    #  Dedupe into one image at a time, readonly images are writable only meanwhile
+    shared = 0
+    for image, pairs in sorted(by_image.items()):
+        try:
+            readonly = btrfs_subvol_is_readonly(runtime / image)
+        except (OSError, subprocess.CalledProcessError):
+            readonly = False  # not a btrfs subvolume
+        if readonly:
+            btrfs_subvol_set_readonly(runtime / image, False)
+        image_shared = 0
+        try:
+            for src, dest, size in pairs:
+                with open(src, "rb") as fsrc, open(dest, "rb+") as fdest:
+                    image_shared += dedupe_file_range(fsrc.fileno(), fdest.fileno(), size)
+        finally:
+            if readonly:
+                btrfs_subvol_set_readonly(runtime / image, True)
+        print("  -> Shared {} in {} files of {}".format(format_size(image_shared), len(pairs), image[:16]))
+        with r.db:
+            r.db.execute("DELETE FROM image_extents WHERE name = ?", (image,))
+        shared += image_shared
+    print("==> Shared {} of data between images".format(format_size(shared)))
+
+
+#  ImageStorage instances opened once by the serve daemon, keyed by runtime path.
+#  Children reconnect to sqlite after fork, so only the schema setup and the
+#  index check are saved, the index itself is not held in memory.
+daemon_storages = {}
+
+#  Client environment variables that change what a command does
+daemon_env_prefix = "NOBY_"
+
+
+def open_storage(runtime, readonly=False):
+    """ImageStorage for runtime, reusing the one the daemon opened when there is one"""
+    runtime = Path(runtime)
+    if runtime in daemon_storages:
+        return daemon_storages[runtime]
+    return ImageStorage(runtime, readonly=readonly)
+
+
+def execute_forked(request, send):
+    """Run a CLI command in a forked child, streaming its output with send
+
+    The child inherits the opened image storage and runs with the NOBY_
+    environment of the client, its stdout and stderr go through a pipe
+    that is forwarded to the client. Returns the exit code.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            os.close(read_fd)
+            devnull = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(devnull, 0)
+            os.dup2(write_fd, 1)
+            os.dup2(write_fd, 2)
+            sys.stdout = open(1, "w", buffering=1, closefd=False)
+            sys.stderr = open(2, "w", buffering=1, closefd=False)
+            os.chdir(request["cwd"])
+            for key in [key for key in os.environ if key.startswith(daemon_env_prefix)]:
+                del os.environ[key]
+            os.environ.update(request.get("env", {}))
+            global btrfs_backend
+            btrfs_backend = os.environ.get("NOBY_BTRFS_BACKEND", "ioctl")
+            operation_slots.count = int(os.environ.get("NOBY_SLOTS", operation_slots.count))
+            args = parseargs(request["argv"])
+            if args.func is serve:
+                raise ValueError("Can't start a daemon from a daemon")
+            operation_slots.directory = Path(args.runtime).resolve() / ".slots"
+            args.func(args)
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            #  The client may be gone already, exit anyway
+            with contextlib.suppress(BaseException):
+                sys.stdout.flush()
+                sys.stderr.flush()
+            os._exit(code)
+
+    os.close(write_fd)
+    try:
+        with os.fdopen(read_fd, "rb") as pipe:
+            for chunk in iter(lambda: pipe.read1(1 << 16), b""):
+                if send is None:
+                    continue  # client disconnected, drain until the command is done
+                try:
+                    send({"output": chunk.decode(errors="replace")})
+                except OSError:
+                    send = None
+    finally:
+        _, status = os.waitpid(pid, 0)
+    return os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+
+
+class ServeHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode())
+
+        def send(message):
+            self.wfile.write(json.dumps(message).encode() + b"\n")
+            self.wfile.flush()
+
+        print("==> {}".format(" ".join(request["argv"])))
+        code = execute_forked(request, send)
+        with contextlib.suppress(OSError):
+            send({"exit": code})
+
+
+def serve(args):
+    runtime = Path(args.runtime).resolve()
+    daemon_storages[runtime] = ImageStorage(runtime)
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)  # stale socket from a previous daemon
+    server = socketserver.ThreadingUnixStreamServer(args.socket, ServeHandler)
+    os.chmod(args.socket, 0o600)
+    operation_slots.count = args.jobs
+    print("==> Serving {} on {}, {} nspawn and btrfs operations at once".format(runtime, args.socket, args.jobs))
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(args.socket)
+
+
+def daemon_client(socket_path, argv):
+    """Run argv on a serve daemon, returns the remote exit code"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        env = {key: value for key, value in os.environ.items() if key.startswith(daemon_env_prefix)}
+        sock.sendall(json.dumps({"argv": argv, "cwd": os.getcwd(), "env": env}).encode() + b"\n")
+        for line in sock.makefile("rb"):
+            message = json.loads(line.decode())
+            if "output" in message:
+                sys.stdout.write(message["output"])
+                sys.stdout.flush()
+            elif "exit" in message:
+                return message["exit"]
+    return 1
 
 
 def strtobool(x):
     return bool(distutils.util.strtobool(x))
 
 
-def parseargs():
+def parseargs(argv=None):
     parser = argparse.ArgumentParser(description='Mini docker like image builder')
     parser.add_argument(
         '--runtime', action='store',
         help='Directory where runtime files are stored. (Default NOBY_RUNTIME env variable or /var/lib/noby)',
         default=os.environ.get('NOBY_RUNTIME', '/var/lib/noby'))
+    parser.add_argument(
+        '--daemon', action='store',
+        metavar='SOCKET',
+        help='Send the command to a noby serve daemon listening on SOCKET. (Default NOBY_DAEMON env variable)',
+        default=os.environ.get('NOBY_DAEMON'))
     parser.add_argument('--version', action='version', version=__version__)
     subparsers = parser.add_subparsers(dest='command', metavar='COMMAND', help='commands')
     subparsers.required = True
@@ -474,25 +3238,118 @@ def parseargs():
         action='append',
         metavar='FOO=bar',
         help='Set or override ENV variables.')
+    build_parser.add_argument('--run-session',
+        action='store',
+        default=False,
+        type=strtobool,
+        metavar='{true, false}',
+        help="Run consecutive RUN steps in one long running container (Default False)")
+    build_parser.add_argument('--coalesce',
+        action='store',
+        default=False,
+        type=strtobool,
+        metavar='{true, false}',
+        help="Seal runs of consecutive HOST or RUN steps as one layer (Default False)")
+    build_parser.add_argument('--squash',
+        action='store',
+        default=False,
+        type=strtobool,
+        metavar='{true, false}',
+        help="Seal the finished image as one layer without parents (Default False)")
+    build_parser.add_argument('--check',
+        action='store_true',
+        help="Only report which steps are cached, exit with 2 if the image needs a build")
+    build_parser.add_argument('--json',
+        action='store_true',
+        help="Print the --check report as JSON")
+    build_parser.add_argument('--watch',
+        action='store_true',
+        help="Rebuild from the first affected step whenever the context or Dockerfile changes")
+    build_parser.add_argument('--debounce',
+        action='store',
+        type=float,
+        default=0.5,
+        metavar='SECONDS',
+        help="With --watch, wait until no changes happen for SECONDS before rebuilding (Default 0.5)")
+    build_parser.add_argument('--trace',
+        action='store',
+        metavar='FILE',
+        help="Write Chrome trace-event JSON with timings of every build phase to FILE")
     build_parser.add_argument('path',
         action='store',
         metavar='PATH',
         help='context for the build')
     build_parser.set_defaults(func=build)
 
+    # Manifest builder argument parser
+    build_all_parser = subparsers.add_parser(
+        'build-all', help='Build all images from a manifest in dependency order')
+    build_all_parser.add_argument('--jobs', '-j',
+        action='store',
+        type=int,
+        default=os.cpu_count(),
+        help="Number of images to build concurrently (Default number of CPUs)")
+    build_all_parser.add_argument('--no-cache',
+        action='store',
+        default=False,
+        type=strtobool,
+        metavar='{true, false}',
+        help="Do not use cached images (Default false)")
+    build_all_parser.add_argument('--rm',
+        action='store',
+        default=False,
+        type=strtobool,
+        metavar='{true, false}',
+        help="Remove intermediate images (Default False)")
+    build_all_parser.add_argument('-e', '--env',
+        action='append',
+        metavar='FOO=bar',
+        help='Set or override ENV variables for all images.')
+    build_all_parser.add_argument('manifest',
+        action='store',
+        metavar='MANIFEST',
+        help="File with one 'CONTEXT DOCKERFILE TAG' line per image")
+    build_all_parser.set_defaults(func=build_all)
+
     # Export parser
     export_parser = subparsers.add_parser(
         'export', help="Export image"
     )
     export_parser.add_argument('--output', '-o',
         action='store',
-        help="File to be written to, defaults to the name of the container image.")
+        help="File to be written to, '-' for stdout, defaults to the name of the container image.")
     export_parser.add_argument('--type',
         action='store',
-        choices=('tar.gz', 'squashfs'),
+        choices=('squashfs', 'tar', 'tar.gz', 'tar.zst', 'btrfs', 'btrfs.gz', 'btrfs.zst'),
         default='squashfs',
         help="Export image type (Default squashfs)"
     )
+    export_parser.add_argument('--threads',
+        action='store',
+        type=int,
+        default=0,
+        help="Compression threads or squashfs processors, 0 uses all cores (Default 0)")
+    export_parser.add_argument('--comp',
+        action='store',
+        choices=('gzip', 'lzo', 'lz4', 'xz', 'zstd'),
+        help="squashfs compressor (Default the mksquashfs default)")
+    export_parser.add_argument('--block-size',
+        action='store',
+        metavar='SIZE',
+        help="squashfs block size like 128K or 1M (Default the mksquashfs default)")
+    export_parser.add_argument('--no-cache',
+        action='store',
+        default=False,
+        type=strtobool,
+        metavar='{true, false}',
+        help="Rebuild the squashfs image even if it was exported with the same options before (Default false)")
+    export_parser.add_argument('--incremental',
+        action='store_true',
+        help="Only export changes since the parent image (btrfs types only)")
+    export_parser.add_argument('--parent',
+        action='store',
+        metavar='IMAGE',
+        help="Tag or hash to diff against with --incremental (Default the parent image)")
     export_parser.add_argument('container',
         action='store',
         metavar='CONTAINER',
@@ -507,11 +3364,15 @@ def parseargs():
     import_parser.add_argument('image',
         action='store',
         metavar='image',
-        help='Name of the image to be imported'
+        help="Name of the image to be imported, '-' reads a tar stream from stdin"
     )
     import_parser.add_argument('--tag', '-t',
         action='store',
         help="Name of the container image to be imported. Defaults to the file name")
+    import_parser.add_argument('--type',
+        action='store',
+        choices=sorted(set(import_types.values())),
+        help="Image type, guessed from the file name by default. Needed when importing from stdin")
     import_parser.set_defaults(func=image_import)
 
     # Run parser
@@ -532,8 +3393,27 @@ def parseargs():
         help="Remove the image after exit (Default True)")
 
     run_parser.add_argument('--volume',
+        action='append',
+        help="Bind mount a volume into the image, can be given many times (See systemd-nspawn --bind option)"
+    )
+
+    run_parser.add_argument('--batch',
         action='store',
-        help="Bind mount a volume into the image (See systemd-nspawn --bind option)"
+        metavar='FILE',
+        help="Run every line of FILE as a command in its own throwaway snapshot, '-' reads stdin"
+    )
+
+    run_parser.add_argument('--jobs', '-j',
+        action='store',
+        type=int,
+        default=os.cpu_count(),
+        help="Number of batch commands to run at once (Default number of CPUs)"
+    )
+
+    run_parser.add_argument('--pool',
+        action='store',
+        type=int,
+        help="Number of snapshots to keep ready for batch commands (Default --jobs)"
     )
 
     run_parser.add_argument('container',
@@ -550,23 +3430,125 @@ def parseargs():
     )
     run_parser.set_defaults(func=run)
 
+    for name, func, help_text in (('push', push, "Push image layers to a registry"),
+                                  ('pull', pull, "Pull image layers from a registry")):
+        registry_parser = subparsers.add_parser(name, help=help_text)
+        registry_parser.add_argument('--registry',
+            action='store',
+            default=os.environ.get('NOBY_REGISTRY'),
+            required='NOBY_REGISTRY' not in os.environ,
+            help="Registry directory (Default NOBY_REGISTRY env variable)")
+        registry_parser.add_argument('container',
+            action='store',
+            metavar='CONTAINER',
+            help='Name of the container image')
+        registry_parser.set_defaults(func=func)
+
     wipe_parser = subparsers.add_parser(
         'wipe', help="Wipe runtime folder"
     )
     wipe_parser.set_defaults(func=wipe)
 
-    return parser.parse_args()
+    gc_parser = subparsers.add_parser(
+        'gc', help="Remove least recently used images that are not reachable from tags"
+    )
+    gc_parser.add_argument('--max-size',
+        action='store',
+        metavar='SIZE',
+        help="Evict until the store is below SIZE, for example 20G")
+    gc_parser.add_argument('--max-age',
+        action='store',
+        metavar='AGE',
+        help="Evict images not used within AGE, for example 7d or 12h")
+    gc_parser.add_argument('--batch',
+        action='store',
+        type=int,
+        default=64,
+        help="Number of subvolumes to delete per transaction commit (Default 64)")
+    gc_parser.add_argument('--dry-run',
+        action='store_true',
+        help="Only print what would be removed")
+    gc_parser.set_defaults(func=gc)
+
+    reindex_parser = subparsers.add_parser(
+        'reindex', help="Rebuild image index from runtime folder"
+    )
+    reindex_parser.set_defaults(func=reindex)
+
+    du_parser = subparsers.add_parser(
+        'du', help="Show referenced and exclusive disk usage of layers and tags"
+    )
+    du_parser.add_argument('--method',
+        choices=('auto', 'qgroups', 'walk'),
+        default='auto',
+        help="Use btrfs qgroups or walk file extents, auto uses qgroups when quotas are enabled (Default auto)")
+    du_parser.add_argument('--jobs', '-j',
+        action='store',
+        type=int,
+        default=os.cpu_count(),
+        help="Number of layers to walk in parallel (Default number of CPUs)")
+    du_parser.add_argument('--json',
+        action='store_true',
+        help="Print the report as JSON")
+    du_parser.set_defaults(func=du)
+
+    dedupe_parser = subparsers.add_parser(
+        'dedupe', help="Share the extents of identical files between images"
+    )
+    dedupe_parser.add_argument('--min-size',
+        action='store',
+        default='4K',
+        metavar='SIZE',
+        help="Ignore files smaller than SIZE (Default 4K)")
+    dedupe_parser.add_argument('--dry-run',
+        action='store_true',
+        help="Only report identical files and the expected savings")
+    dedupe_parser.set_defaults(func=dedupe)
+
+    cache_parser = subparsers.add_parser(
+        'cache', help="Inspect the layer cache"
+    )
+    cache_subparsers = cache_parser.add_subparsers(dest='cache_command', metavar='COMMAND', help='cache commands')
+    cache_subparsers.required = True
+    cache_tree_parser = cache_subparsers.add_parser(
+        'tree', help="Show the layer tree with prefixes shared between tagged images"
+    )
+    cache_tree_parser.set_defaults(func=cache_tree)
+
+    serve_parser = subparsers.add_parser(
+        'serve', help="Run a build daemon that executes commands sent over a Unix socket"
+    )
+    serve_parser.add_argument('--socket',
+        action='store',
+        default=os.environ.get('NOBY_DAEMON', '/run/noby.sock'),
+        help="Socket to listen on (Default NOBY_DAEMON env variable or /run/noby.sock)")
+    serve_parser.add_argument('--jobs', '-j',
+        action='store',
+        type=int,
+        default=operation_slots.count,
+        help="Number of nspawn and btrfs operations to run at once, "
+             "clients can override it with NOBY_SLOTS (Default NOBY_SLOTS env variable or number of CPUs)")
+    serve_parser.set_defaults(func=serve)
+
+    return parser.parse_args(argv)
 
 
 def main():
     args = parseargs()
 
-    if os.getuid() != 0:
+    if args.daemon and args.func is not serve:
+        sys.exit(daemon_client(args.daemon, sys.argv[1:]))
+
+    #  build --check only reads the runtime store
+    check = getattr(args, "check", False)
+    if os.getuid() != 0 and not check:
         print("This script must be run as root")
         sys.exit(1)
 
     runtime = Path(args.runtime).resolve()
-    runtime.mkdir(parents=True, exist_ok=True)
+    if not check:
+        runtime.mkdir(parents=True, exist_ok=True)
+        operation_slots.directory = runtime / ".slots"
 
     if hasattr(args, "func"):
         args.func(args)
@@ -27,3 +27,9 @@ sudo ./noby.py build -f Dockerfile-env .
 sudo ./noby.py wipe
 #Should override BAR value and add DEV value
 sudo ./noby.py build -e BAR=modified --env DEV=devvalue -f Dockerfile-env .
+
+#Test multi-stage builds
+sudo ./noby.py wipe
+sudo ./noby.py build -f Dockerfile . -t busybox
+sudo ./noby.py build -f Dockerfile-multistage . -t multistage
+sudo ./noby.py run multistage "cat /artifact"
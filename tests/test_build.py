@@ -0,0 +1,371 @@
+import io
+import os
+import json
+import shutil
+import time
+import subprocess
+import argparse
+import tempfile
+import threading
+import contextlib
+import unittest
+from unittest import mock
+from pathlib import Path
+import noby
+from benchmarks.fake_backend import FakeBackend
+
+
+class BuildTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.context = Path(self.tmp.name) / "context"
+        self.runtime = Path(self.tmp.name) / "runtime"
+        self.context.mkdir()
+        self.runtime.mkdir()
+        self.backend = self.enterContext(FakeBackend().installed())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def build(self, dockerfile="Dockerfile", **kwargs):
+        args = argparse.Namespace(
+            runtime=str(self.runtime), path=str(self.context), file=dockerfile,
+            tag=None, no_cache=False, rm=False, env=None, check=False, json=False,
+            coalesce=False, squash=False)
+        vars(args).update(kwargs)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            noby.build(args)
+        return output.getvalue()
+
+    def test_concurrent_builds_share_steps(self):
+        (self.context / "Dockerfile").write_text(
+            "FROM scratch\n"
+            "HOST echo one >> $CONTEXT/log && sleep 0.2 && echo one > $TARGET/one\n"
+            "HOST echo two >> $CONTEXT/log\n")
+        builders = [threading.Thread(target=self.build, kwargs={"tag": "t{}".format(n)}) for n in range(3)]
+        for builder in builders:
+            builder.start()
+        for builder in builders:
+            builder.join()
+
+        self.assertEqual((self.context / "log").read_text(), "one\ntwo\n")
+        r = noby.ImageStorage(self.runtime)
+        self.assertEqual(len({r.find_last_build_by_name("t{}".format(n)) for n in range(3)}), 1)
+
+    def test_resume_from_cached_prefix(self):
+        dockerfile = self.context / "Dockerfile"
+        dockerfile.write_text(
+            "FROM scratch\n"
+            "HOST echo one >> $CONTEXT/log\n"
+            "HOST echo two >> $CONTEXT/log\n")
+        self.build(tag="first")
+        dockerfile.write_text(dockerfile.read_text() + "HOST echo three >> $CONTEXT/log\n")
+        self.build(tag="second")
+        self.build(tag="second")
+        self.assertEqual((self.context / "log").read_text(), "one\ntwo\nthree\n")
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            noby.cache_tree(argparse.Namespace(runtime=str(self.runtime)))
+        self.assertIn("[second]", output.getvalue())
+        self.assertIn("Tags reference 5 layers stored as 3, 2 (40%) reused", output.getvalue())
+
+    def test_lost_index_row_is_restored(self):
+        dockerfile = self.context / "Dockerfile"
+        dockerfile.write_text("FROM scratch\nHOST echo one > $TARGET/one\n")
+        self.build(tag="first")
+        r = noby.ImageStorage(self.runtime)
+        first = r.tags()["first"]
+        attrs = r.get(first)
+        with r.db:
+            r.db.execute("DELETE FROM images WHERE name = ?", (first,))  # crashed before add_image
+
+        dockerfile.write_text(dockerfile.read_text() + "HOST echo two > $TARGET/two\n")
+        self.build(tag="second")
+        self.assertEqual(r.get(first), attrs)
+        self.assertIn(first, r.reachable())
+
+    def test_copy_from_stays_in_image(self):
+        (self.context / "Dockerfile").write_text(
+            "FROM scratch AS source\n"
+            "HOST mkdir -p $TARGET/usr/lib && echo image > $TARGET/usr/lib/file && ln -s /usr/lib $TARGET/lib\n"
+            "FROM scratch\n"
+            "HOST mkdir $TARGET/usr && ln -s /usr $TARGET/opt\n"
+            "COPY --from=source /lib/file /opt/file\n")
+        self.build(tag="t")
+        image = self.runtime / noby.ImageStorage(self.runtime).tags()["t"]
+        self.assertEqual((image / "usr" / "file").read_text(), "image\n")
+        self.assertFalse(Path("/usr/file").exists())
+
+    def test_run_session(self):
+        (self.context / "Dockerfile").write_text(
+            "FROM scratch\n"
+            "RUN echo one > one\n"
+            "RUN echo two > two && echo printed\n"
+            "HOST echo host > $TARGET/host\n"
+            "RUN cat one two host > all\n")
+        plain = Path(self.tmp.name) / "plain"
+        plain.mkdir()
+        self.build(runtime=str(plain), tag="t")
+        self.assertEqual(self.backend.counts["nspawn"], 3)
+
+        output = self.build(tag="t", run_session=True)
+        self.assertIn("printed\n", output)
+        self.assertIn("RUN session ran 2 steps", output)
+        self.assertEqual(self.backend.counts["nspawn"], 3 + 2)  # HOST closed the first session
+
+        r, expected = noby.ImageStorage(self.runtime), noby.ImageStorage(plain)
+        image = r.tags()["t"]
+        self.assertEqual(image, expected.tags()["t"])
+        while image:
+            self.assertEqual(r.get(image), expected.get(image))
+            self.assertEqual(sorted(os.listdir(str(self.runtime / image))), sorted(os.listdir(str(plain / image))))
+            image = r.get(image)["parent_hash"]
+        self.assertEqual((self.runtime / r.tags()["t"] / "all").read_text(), "one\ntwo\nhost\n")
+        self.assertEqual([name for name in os.listdir(str(self.runtime)) if name.endswith("-init")], [])
+
+        self.build(tag="t", run_session=True)
+        self.assertEqual(self.backend.counts["nspawn"], 5)  # cached, no session started
+
+    def test_run_session_releases_sealed_steps(self):
+        (self.context / "Dockerfile").write_text(
+            "FROM scratch\n"
+            "RUN echo one > one\n"
+            "RUN sleep 1 && echo two > two\n")
+        (self.context / "Dockerfile-other").write_text(
+            "FROM scratch\n"
+            "RUN echo one > one\n"
+            "RUN echo other > other\n")
+        finished = {}
+
+        def build(name, dockerfile):
+            self.build(dockerfile, tag=name, run_session=True)
+            finished[name] = time.monotonic()
+        first = threading.Thread(target=build, args=("first", "Dockerfile"))
+        first.start()
+        while not any(not path.name.startswith(".") and not path.name.endswith("-init")
+                      for path in self.runtime.iterdir()):
+            time.sleep(0.01)
+        #  The first step is sealed while the session still runs the second one
+        second = threading.Thread(target=build, args=("second", "Dockerfile-other"))
+        second.start()
+        second.join(10)
+        first.join(10)
+        self.assertFalse(first.is_alive() or second.is_alive())
+        self.assertLess(finished["second"], finished["first"])
+
+        r = noby.ImageStorage(self.runtime)
+        first, second = r.tags()["first"], r.tags()["second"]
+        self.assertEqual(r.get(first)["parent_hash"], r.get(second)["parent_hash"])
+        self.assertEqual(sorted(os.listdir(str(self.runtime / first))), ["one", "two"])
+        self.assertEqual(sorted(os.listdir(str(self.runtime / second))), ["one", "other"])
+        self.assertEqual(os.listdir(str(self.runtime / ".locks")), [])
+
+    def test_removed_parent_is_built_again(self):
+        dockerfile = self.context / "Dockerfile"
+        dockerfile.write_text("FROM scratch\nHOST echo one >> $CONTEXT/log && echo one > $TARGET/one\n")
+        self.build(tag="first")
+        first = noby.ImageStorage(self.runtime).tags()["first"]
+        dockerfile.write_text(dockerfile.read_text() + "HOST echo two >> $CONTEXT/log\n")
+
+        cached_prefix = noby.ImageStorage.cached_prefix
+
+        def removed_after_lookup(r, build_hashes, parent_hash=""):
+            count = cached_prefix(r, build_hashes, parent_hash)
+            if (self.runtime / first).exists():
+                #  A concurrent build --rm removes the layer right after it was found
+                shutil.rmtree(str(self.runtime / first))
+                r.remove_image(first)
+            return count
+        with mock.patch.object(noby.ImageStorage, "cached_prefix", removed_after_lookup):
+            self.build(tag="second")
+        self.assertEqual((self.context / "log").read_text(), "one\none\ntwo\n")
+        self.assertEqual(os.listdir(str(self.runtime / first)), ["one"])
+
+    def test_rm_skips_layers_in_use(self):
+        (self.context / "Dockerfile").write_text(
+            "FROM scratch\n"
+            "HOST echo one > $TARGET/one\n"
+            "HOST echo two > $TARGET/two\n")
+        self.build(tag="t")
+        r = noby.ImageStorage(self.runtime)
+        image = r.tags()["t"]
+        first = r.get(image)["parent_hash"]
+        lock = noby.StepLock(self.runtime, first)
+        lock.acquire(shared=True)
+        self.addCleanup(lock.release)
+        self.build(tag="t", rm=True)
+        self.assertTrue((self.runtime / first).exists())
+
+    def test_trace(self):
+        (self.context / "Dockerfile").write_text(
+            "FROM scratch\n"
+            "HOST echo one > $TARGET/one\n"
+            "COPY Dockerfile /\n")
+        trace = Path(self.tmp.name) / "trace.json"
+        self.build(tag="t", trace=str(trace))
+        events = json.loads(trace.read_text())["traceEvents"]
+        steps = [event["args"] for event in events if event["name"] == "step"]
+        self.assertEqual([(step["cmd"], step["cache"]) for step in steps], [("host", "miss"), ("copy", "miss")])
+        self.assertEqual(steps[1]["bytes"], (self.context / "Dockerfile").stat().st_size)
+        locks = [event["args"] for event in events if event["name"] == "lock"]
+        self.assertEqual([(lock["hash"], lock["cache"]) for lock in locks], [(step["hash"], "miss") for step in steps])
+
+        self.build(tag="t", trace=str(trace))
+        events = json.loads(trace.read_text())["traceEvents"]
+        cached = [event["args"] for event in events if event["name"] == "step"]
+        self.assertEqual([(step["hash"], step["cache"]) for step in cached], [(step["hash"], "hit") for step in steps])
+        self.assertTrue(all(event["ph"] == "X" and event["dur"] >= 0 for event in events))
+
+    def test_coalesce_and_squash(self):
+        (self.context / "Dockerfile").write_text(
+            "FROM scratch\n"
+            "HOST echo one > $TARGET/one\n"
+            "HOST cd $TARGET && echo two > two\n"
+            "HOST test ! -f two && echo three > $TARGET/three\n")
+        self.build(tag="t", coalesce=True, squash=True)
+
+        r = noby.ImageStorage(self.runtime)
+        image = r.tags()["t"]
+        self.assertEqual(r.get(image)["parent_hash"], "")
+        self.assertEqual(sorted(os.listdir(str(self.runtime / image))), ["one", "three", "two"])
+        self.assertEqual(r.reachable(), {image})
+        layers = r.get(image)["squashed_from"]
+        self.assertEqual(r.get(layers)["parent_hash"], "")  # all three steps sealed as one layer
+
+        (self.context / "Dockerfile").write_text(
+            (self.context / "Dockerfile").read_text() + "HOST false\nHOST echo never > $TARGET/never\n")
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.build(tag="t", coalesce=True, squash=True)
+        self.assertEqual(r.tags()["t"], image)
+
+    def test_check(self):
+        (self.context / "Dockerfile").write_text(
+            "FROM scratch\n"
+            "HOST echo one > $TARGET/one\n"
+            "HOST echo two > $TARGET/two\n")
+        output = io.StringIO()
+        with self.assertRaises(SystemExit) as cm, contextlib.redirect_stdout(output):
+            noby.build(argparse.Namespace(
+                runtime=str(self.runtime), path=str(self.context), file="Dockerfile",
+                tag="t", no_cache=False, env=None, check=True, json=True))
+        self.assertEqual(cm.exception.code, 2)
+        status = json.loads(output.getvalue())
+        self.assertFalse(status["up_to_date"])
+        self.assertEqual([step["cached"] for step in status["steps"]], [False, False])
+
+        self.build(tag="t")
+        db = (self.runtime / noby.metadata_db_name).read_bytes()
+        self.build(tag="t", check=True)
+        self.assertEqual((self.runtime / noby.metadata_db_name).read_bytes(), db)  # the index is not written
+        self.assertEqual(sorted(os.listdir(str(self.runtime / status["image"]))), ["one", "two"])
+
+    def test_run_batch(self):
+        image = self.runtime / "image"
+        image.mkdir()
+        (image / "data").write_text("x")
+        args = argparse.Namespace(volume=None, jobs=3, pool=2)
+        commands = ["test -f data && rm data"] * 5 + ["exit 3"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = noby.run_batch(image, {}, commands, args)
+
+        self.assertEqual([code for code, duration in results], [0] * 5 + [3])
+        self.assertEqual(os.listdir(str(self.runtime / ".run")), [])
+        self.assertTrue((image / "data").exists())
+
+    def test_inotify(self):
+        inotify = noby.Inotify()
+        self.addCleanup(inotify.close)
+        inotify.watch_tree(self.context)
+        (self.context / "sub").mkdir()
+        self.assertEqual(inotify.wait(0.05), {self.context / "sub"})
+        (self.context / "sub" / "file").write_text("x")
+        self.assertEqual(inotify.wait(0.05), {self.context / "sub" / "file"})
+        self.assertEqual(inotify.drain(), set())
+
+    def test_readonly_subvolume(self):
+        image = self.runtime / "image"
+        image.mkdir()
+        for readonly in (True, False):
+            with mock.patch.object(noby, "btrfs_subvol_is_readonly", lambda path: readonly):
+                with noby.readonly_subvolume(image) as source:
+                    self.assertEqual(source == image, readonly)
+                    self.assertTrue(source.exists())
+                self.assertEqual(os.listdir(str(self.runtime)), ["image"])
+
+    def test_daemon_uses_client_environment(self):
+        output = []
+        code = noby.execute_forked(
+            {"argv": ["reindex"], "cwd": str(self.context), "env": {"NOBY_RUNTIME": str(self.runtime)}},
+            lambda message: output.append(message["output"]))
+        self.assertEqual(code, 0)
+        self.assertIn("Reindexing runtime store {}".format(self.runtime), "".join(output))
+
+    def test_daemon_client_disconnect(self):
+        calls = []
+
+        def send(message):
+            calls.append(message)
+            raise BrokenPipeError()
+        code = noby.execute_forked(
+            {"argv": ["reindex"], "cwd": str(self.context), "env": {"NOBY_RUNTIME": str(self.runtime)}}, send)
+        self.assertEqual(code, 0)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue((self.runtime / noby.metadata_db_name).exists())
+
+    def test_operation_slots(self):
+        slots = noby.OperationSlots(1)
+        slots.directory = self.runtime / ".slots"
+        order = []
+
+        def operation(name):
+            with slots.hold():
+                order.append(name + " start")
+                time.sleep(0.1)
+                order.append(name + " end")
+        with slots.hold(), slots.hold():  # nested operations share the slot
+            other = threading.Thread(target=operation, args=("other",))
+            other.start()
+            time.sleep(0.1)
+            order.append("first")
+        other.join()
+        self.assertEqual(order, ["first", "other start", "other end"])
+
+    def test_stale_lock(self):
+        lock = noby.StepLock(self.runtime, "abc")
+        lock.path.parent.mkdir()
+        lock.path.write_text("99999\n")
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            lock.acquire()
+        lock.release()
+        self.assertIn("stale lock", output.getvalue())
+        self.assertFalse(lock.path.exists())
+
+    def test_lock_file_removed(self):
+        first, second = noby.StepLock(self.runtime, "abc"), noby.StepLock(self.runtime, "abc")
+        first.acquire()
+        waiter = threading.Thread(target=second.acquire)
+        with contextlib.redirect_stdout(io.StringIO()):
+            waiter.start()
+            time.sleep(0.1)
+            first.release()
+            waiter.join()
+        #  The waiter locked the file first removed and moved on to a new one
+        self.assertEqual(os.fstat(second.fd).st_ino, second.path.stat().st_ino)
+
+        shared = noby.StepLock(self.runtime, "abc")
+        self.assertFalse(shared.acquire(blocking=False))
+        second.release()
+        shared.acquire(shared=True)
+        other = noby.StepLock(self.runtime, "abc")
+        other.acquire(shared=True)
+        shared.release()
+        self.assertTrue(other.path.exists())  # still held by the other shared holder
+        other.release()
+        self.assertEqual(os.listdir(str(self.runtime / ".locks")), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import unittest
+import tempfile
+from pathlib import Path
+import noby
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+class ManifestTestCase(unittest.TestCase):
+    def test_dependencies(self):
+        entries = noby.load_manifest(ROOT / "images.manifest")
+        self.assertEqual(entries["busybox"], (ROOT, "Dockerfile"))
+        dependencies = noby.manifest_dependencies(entries)
+        self.assertEqual(dependencies["busybox-from"], {"busybox"})
+        self.assertEqual(dependencies["busybox"], set())
+
+    def test_cycle(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            (tmp / "a").write_text("FROM b\nRUN true\n")
+            (tmp / "b").write_text("FROM a\nRUN true\n")
+            (tmp / "manifest").write_text(". a a\n. b b\n")
+            with self.assertRaises(ValueError):
+                noby.manifest_dependencies(noby.load_manifest(tmp / "manifest"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import unittest
+import tempfile
+from pathlib import Path
+import noby
+
+
+class CopyTreeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.context = Path(self.tmp.name) / "context"
+        self.target = Path(self.tmp.name) / "target"
+        self.target.mkdir()
+        (self.context / "dir" / "sub").mkdir(parents=True)
+        (self.context / "file").write_text("file")
+        (self.context / "dir" / "sub" / "nested").write_text("nested")
+        (self.context / "dir" / "script").write_text("#!/bin/sh")
+        os.chmod(str(self.context / "dir" / "script"), 0o751)
+        os.symlink("sub/nested", str(self.context / "dir" / "link"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_cp_semantics(self):
+        stats = noby.copy_tree(["file", "dir/."], self.target, cwd=self.context)
+        self.assertEqual((self.target / "file").read_text(), "file")
+        self.assertEqual((self.target / "sub" / "nested").read_text(), "nested")
+        self.assertEqual(os.readlink(str(self.target / "link")), "sub/nested")
+        self.assertEqual(os.stat(str(self.target / "script")).st_mode & 0o777, 0o751)
+        self.assertEqual((stats.files, stats.links), (3, 1))
+
+        noby.copy_tree(["dir"], self.target / "copy", cwd=self.context)
+        self.assertEqual((self.target / "copy" / "sub" / "nested").read_text(), "nested")
+        noby.copy_tree(["dir"], self.target / "copy", cwd=self.context)
+        self.assertTrue((self.target / "copy" / "dir" / "script").is_file())
+
+    def test_existing_dest_keeps_metadata(self):
+        os.chmod(str(self.context / "dir"), 0o700)
+        os.chmod(str(self.target), 0o755)
+        if os.getuid() == 0:
+            os.chown(str(self.context / "dir"), 1234, 1234)
+        owner = os.stat(str(self.target)).st_uid
+        noby.copy_tree(["dir/."], self.target, cwd=self.context)
+        st = os.stat(str(self.target))
+        self.assertEqual((st.st_mode & 0o777, st.st_uid), (0o755, owner))
+        self.assertEqual(os.stat(str(self.target / "sub")).st_mtime,
+                         os.stat(str(self.context / "dir" / "sub")).st_mtime)
+
+        noby.copy_tree(["dir"], self.target, cwd=self.context)
+        self.assertEqual(os.stat(str(self.target / "dir")).st_mode & 0o777, 0o700)
+
+    def test_resolve_in_root(self):
+        root = Path(self.tmp.name) / "root"
+        (root / "usr" / "lib64").mkdir(parents=True)
+        os.symlink("/usr/lib64", str(root / "lib"))
+        os.symlink("../..", str(root / "usr" / "up"))
+        os.symlink("loop", str(root / "loop"))
+        self.assertEqual(noby.resolve_in_root(root, "/lib/libc.so"), root / "usr" / "lib64" / "libc.so")
+        self.assertEqual(noby.resolve_in_root(root, "usr/up/../etc/passwd"), root / "etc" / "passwd")
+        self.assertEqual(noby.resolve_in_root(root, "../../lib/."), root / "usr" / "lib64")
+        self.assertEqual(noby.resolve_in_root(root, "/lib"), root / "lib")
+        self.assertEqual(noby.resolve_in_root(root, "/lib", follow_last=True), root / "usr" / "lib64")
+        with self.assertRaises(OSError):
+            noby.resolve_in_root(root, "loop/file")
+
+    def test_missing_source(self):
+        with self.assertRaises(FileNotFoundError):
+            noby.copy_tree(["missing"], self.target, cwd=self.context)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,16 @@
 import unittest
 import io
+import tempfile
+from pathlib import Path
 import noby
 
+
+def parse(text):
+    dockerfile = io.StringIO(text)
+    dockerfile.open = lambda: dockerfile
+    return noby.DockerfileParser(dockerfile)
+
+
 class DockerfileTestCase(unittest.TestCase):
     def test_load(self):
         dockerfile = io.StringIO("""
@@ -16,6 +25,100 @@ class DockerfileTestCase(unittest.TestCase):
         parser = noby.DockerfileParser(dockerfile)
         self.assertEqual(parser.env, {"bla":"bla"})
 
+    def test_copy_hash_follows_content(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            context = Path(tmp)
+            (context / "src").mkdir()
+            (context / "src" / "file").write_text("one")
+            parser = parse("FROM scratch\nHOST echo\nCOPY src /src\n")
+            index = noby.FileHashIndex()
+
+            parser.calc_build_hashes(context=context, file_hashes=index)
+            first = list(parser.build_hashes)
+            parser.calc_build_hashes(context=context, file_hashes=index)
+            self.assertEqual(first, parser.build_hashes)
+
+            (context / "src" / "file").write_text("two!")
+            parser.calc_build_hashes(context=context, file_hashes=index)
+            self.assertEqual(first[0], parser.build_hashes[0])
+            self.assertNotEqual(first[1], parser.build_hashes[1])
+
+    def test_env_hashes(self):
+        dockerfile = """
+        FROM scratch
+        ENV FOO=foovalue
+        ENV BAR=unmodified
+        HOST echo "FOO: ${FOO}"
+        HOST echo "BAR: $BAR"
+        HOST echo "DEV: ${DEV:-none}"
+        """
+        parser = parse(dockerfile)
+        parser.calc_build_hashes()
+        default = list(parser.build_hashes)
+        self.assertEqual(parser.referenced_env('echo ${DEV:-none} $FOO'), ["DEV", "FOO"])
+
+        parser = parse(dockerfile)
+        parser.add_env_variables(["BAR=modified"])
+        parser.calc_build_hashes()
+        self.assertEqual(default[0], parser.build_hashes[0])
+        self.assertNotEqual(default[1], parser.build_hashes[1])
+
+        parser = parse(dockerfile)
+        parser.add_env_variables(["UNUSED=1"])
+        parser.calc_build_hashes()
+        self.assertEqual(default, parser.build_hashes)
+
+    def test_stages(self):
+        parser = parse("""
+        FROM busybox AS builder
+        RUN make
+        FROM scratch AS other
+        HOST echo other
+        FROM debian
+        COPY --from=builder /out/app /app
+        RUN true
+        """)
+        self.assertEqual([stage.label for stage in parser.stages], ["builder", "other", "2"])
+        self.assertEqual(parser.from_image, "debian")
+        self.assertEqual(parser.build_commands[1], ("run", "true"))
+        self.assertEqual(parser.base_images(), ["busybox", "debian"])
+        self.assertEqual([stage.label for stage in parser.required_stages()], ["builder", "2"])
+
+        parser.calc_build_hashes(base_hashes={"busybox": "a" * 64, "debian": "b" * 64})
+        builder_hashes = parser.stages[0].build_hashes
+        final_hashes = list(parser.build_hashes)
+        self.assertEqual(parser.stages[2].parent_hash, "b" * 64)
+
+        parser.calc_build_hashes(base_hashes={"busybox": "c" * 64, "debian": "b" * 64})
+        self.assertNotEqual(builder_hashes, parser.stages[0].build_hashes)
+        self.assertNotEqual(final_hashes, parser.build_hashes)
+
+    def test_copy_args(self):
+        self.assertEqual(noby.parse_copy_args("--from=build /a /b /dest"), ("build", ["/a", "/b"], "/dest"))
+        self.assertEqual(noby.parse_copy_args("a b"), (None, ["a"], "b"))
+        with self.assertRaises(ValueError):
+            noby.parse_copy_args("--chown=1 a b")
+
+    def test_first_affected_step(self):
+        parser = parse("FROM scratch\nCOPY src /src\nRUN make\nCOPY docs/. /docs\nHOST echo\n")
+        parser.calc_build_hashes()
+        context = Path("/context")
+        def affected(*paths):
+            step = parser.first_affected_step(context, [context / path for path in paths])
+            return step and step[1]
+        self.assertEqual(affected("src/main.c"), 0)
+        self.assertEqual(affected("docs/index.md"), 2)
+        self.assertEqual(affected("docs"), 2)
+        self.assertEqual(affected("other"), 3)
+        self.assertIsNone(affected())
+
+
+    def test_coalesce_steps(self):
+        parser = parse("FROM scratch\nHOST a\nHOST b # note\nRUN c\nRUN d\nCOPY x /x\nCOPY y /y\nHOST e\n")
+        self.assertEqual(parser.coalesce_steps(), 2)
+        self.assertEqual(parser.build_commands, [
+            ("host", "(a\n) && (b # note\n)"), ("run", "(c\n) && (d\n)"),
+            ("copy", "x /x"), ("copy", "y /y"), ("host", "e")])
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,277 @@
+import io
+import os
+import errno
+import struct
+import subprocess
+import argparse
+import contextlib
+import unittest
+from unittest import mock
+import tempfile
+from pathlib import Path
+import noby
+from benchmarks.fake_backend import FakeBackend
+
+
+class ImageStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.runtime = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_index_lookups(self):
+        r = noby.ImageStorage(self.runtime)
+        r.add_image("aaa", {"parent_hash": "", "cmd.host": "echo"})
+        r.add_image("bbb", {"parent_hash": "aaa", "cmd.run": "true"})
+        r.add_image("ccc", {"parent_hash": "aaa", "cmd.run": "false"})
+
+        r = noby.ImageStorage(self.runtime)
+        children = sorted(name for name, attrs in r.find_children("aaa"))
+        self.assertEqual(children, ["bbb", "ccc"])
+        self.assertEqual(r.get("bbb")["cmd.run"], "true")
+
+        r.remove_image("bbb")
+        self.assertEqual([name for name, attrs in r.find_children("aaa")], ["ccc"])
+
+    def test_readonly(self):
+        r = noby.ImageStorage(self.runtime, readonly=True)
+        self.assertEqual(r.images, {})
+        self.assertFalse((self.runtime / noby.metadata_db_name).exists())  # indexed in memory only
+
+        noby.ImageStorage(self.runtime).add_image("aaa", {"parent_hash": ""})
+        r = noby.ImageStorage(self.runtime, readonly=True)
+        self.assertEqual(r.get("aaa"), {"parent_hash": ""})
+        with self.assertRaises(noby.sqlite3.OperationalError):
+            r.touch("aaa")
+
+    def test_cached_prefix(self):
+        r = noby.ImageStorage(self.runtime)
+        for name, parent in (("aaa", ""), ("bbb", "aaa"), ("ccc", "bbb"), ("xxx", "other")):
+            (self.runtime / name).mkdir()
+            r.add_image(name, {"parent_hash": parent})
+        self.assertEqual(r.cached_prefix(["aaa", "bbb", "ccc", "ddd"]), 3)
+        self.assertEqual(r.cached_prefix(["aaa", "xxx", "ccc"]), 1)
+        self.assertEqual(r.cached_prefix(["bbb", "ccc"], "aaa"), 2)
+        self.assertEqual(r.cached_prefix(["bbb", "ccc"], "zzz"), 0)
+
+        (self.runtime / "ccc").rmdir()
+        self.assertEqual(r.cached_prefix(["aaa", "bbb", "ccc"]), 2)
+
+    def test_disk_usage(self):
+        r = noby.ImageStorage(self.runtime)
+        for name, parent in (("base", ""), ("one", "base"), ("two", "base")):
+            (self.runtime / name).mkdir()
+            r.add_image(name, {"parent_hash": parent, "cmd.run": name})
+        (self.runtime / "base" / "shared").write_bytes(b"s" * 65536)
+        for name in ("one", "two"):
+            os.link(str(self.runtime / "base" / "shared"), str(self.runtime / name / "shared"))
+            (self.runtime / name / "own").write_bytes(b"o" * 8192)
+        r.tag("one", "one")
+
+        usage = noby.disk_usage(r, method="walk")
+        layers = {layer["image"]: layer for layer in usage["layers"]}
+        self.assertEqual(layers["one"]["referenced"], 65536 + 8192)
+        self.assertEqual(layers["one"]["exclusive"], 8192)
+        self.assertEqual(layers["base"]["exclusive"], 0)
+        self.assertEqual(layers["one"]["tags"], ["one"])
+        self.assertEqual(usage["tags"], [{"tag": "one", "image": "one", "referenced": 65536 + 8192, "exclusive": 8192}])
+        self.assertEqual(usage["total"], 65536 + 2 * 8192)
+
+    def test_dedupe_plan(self):
+        r = noby.ImageStorage(self.runtime)
+        for name in ("aaa", "bbb", "ccc"):
+            (self.runtime / name).mkdir()
+            r.add_image(name, {"parent_hash": ""})
+        (self.runtime / "aaa" / "busybox").write_bytes(b"b" * 8192)
+        (self.runtime / "bbb" / "busybox").write_bytes(b"b" * 8192)
+        os.link(str(self.runtime / "aaa" / "busybox"), str(self.runtime / "ccc" / "busybox"))
+        (self.runtime / "ccc" / "other").write_bytes(b"o" * 8192)
+        (self.runtime / "ccc" / "small").write_bytes(b"b")
+
+        groups = noby.dedupe_plan(r)
+        self.assertEqual(groups, [(8192, [str(self.runtime / "aaa" / "busybox"), str(self.runtime / "bbb" / "busybox")])])
+
+    def test_dedupe_targets(self):
+        groups = [(10, [str(self.runtime / name / "file") for name in ("aaa", "bbb", "ccc")])]
+        targets = noby.dedupe_targets(self.runtime, groups, received={"bbb", "ccc"})
+        self.assertEqual(targets, {"aaa": [(str(self.runtime / "bbb" / "file"), str(self.runtime / "aaa" / "file"), 10)]})
+        targets = noby.dedupe_targets(self.runtime, groups)
+        self.assertEqual(sorted(targets), ["bbb", "ccc"])
+
+    def test_import_reads_archive_once(self):
+        archive = Path(self.tmp.name) / "rootfs.tar"
+        (Path(self.tmp.name) / "rootfs").mkdir()
+        (Path(self.tmp.name) / "rootfs" / "file").write_text("x")
+        subprocess.run(("tar", "-C", str(Path(self.tmp.name) / "rootfs"), "-cf", str(archive), "."), check=True)
+        runtime = self.runtime / "runtime"
+        runtime.mkdir()
+        args = lambda tag: argparse.Namespace(runtime=str(runtime), image=str(archive), tag=tag, type=None)
+
+        with FakeBackend().installed(), \
+                mock.patch.object(noby.FileHashIndex, "file_digest", side_effect=AssertionError), \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            noby.image_import(args("one"))
+            noby.image_import(args("two"))
+        self.assertIn("was already imported", output.getvalue())
+        tags = noby.ImageStorage(runtime).tags()
+        self.assertEqual(tags["one"], tags["two"])
+
+    def test_btrfs_ioctl_fallback(self):
+        args = noby._btrfs_vol_args(3, "name")
+        self.assertEqual(len(args), 4096)
+        self.assertEqual(len(args), (noby.BTRFS_IOC_SUBVOL_CREATE >> 16) & 0x3fff)
+        self.assertEqual(struct.unpack_from("q4s", args), (3, b"name"))
+        args = noby._btrfs_vol_args_v2(4, "snap", noby.BTRFS_SUBVOL_RDONLY)
+        self.assertEqual(len(args), 4096)
+        self.assertEqual(len(args), (noby.BTRFS_IOC_SNAP_CREATE_V2 >> 16) & 0x3fff)
+        self.assertEqual(struct.unpack_from("qQQ", args), (4, 0, noby.BTRFS_SUBVOL_RDONLY))
+        self.assertEqual(args[56:60], b"snap")
+
+        (self.runtime / "src").mkdir()
+        enotty = OSError(errno.ENOTTY, "Inappropriate ioctl for device")
+        with mock.patch.object(noby.fcntl, "ioctl", side_effect=enotty) as ioctl, \
+                mock.patch.object(noby, "_btrfs_cli") as cli:
+            noby.btrfs_subvol_create(self.runtime / "sub")
+            noby.btrfs_subvol_snapshot(self.runtime / "src", self.runtime / "snap", readonly=True)
+        self.assertEqual(ioctl.call_count, 2)
+        self.assertEqual(cli.call_args_list, [
+            mock.call("create", str(self.runtime / "sub")),
+            mock.call("snapshot", "-r", str(self.runtime / "src"), str(self.runtime / "snap"))])
+
+        with mock.patch.object(noby.fcntl, "ioctl", side_effect=OSError(errno.EPERM, "denied")), \
+                mock.patch.object(noby, "_btrfs_cli") as cli, self.assertRaises(PermissionError):
+            noby.btrfs_subvol_create(self.runtime / "sub")
+        cli.assert_not_called()
+
+    def test_stream_export(self):
+        self.assertEqual(noby.compressor_cmd("zst", 4), ["zstd", "-q", "-c", "-T4"])
+        self.assertIsNone(noby.compressor_cmd(None))
+        with self.assertRaises(NotImplementedError):
+            noby.compressor_cmd("bz2")
+
+        output = self.runtime / "out"
+        producer = ["printf", "data"]
+        with mock.patch.object(noby, "compressor_cmd", lambda compression, threads=0: None):
+            noby.stream_export(producer, str(output))
+        self.assertEqual(output.read_bytes(), b"data")
+
+        with mock.patch.object(noby, "compressor_cmd", lambda compression, threads=0: ["sed", "s/a/A/g"]):
+            noby.stream_export(producer, str(output), "gz")
+            self.assertEqual(output.read_bytes(), b"dAtA")
+            with open(str(output), "w") as stdout, mock.patch.object(noby.sys, "stdout", stdout):
+                noby.stream_export(producer, "-", "gz")
+            self.assertEqual(output.read_bytes(), b"dAtA")
+
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                noby.stream_export(["sh", "-c", "printf data; exit 2"], str(output), "gz")
+            self.assertEqual(cm.exception.returncode, 2)
+
+        with mock.patch.object(noby, "compressor_cmd", lambda compression, threads=0: ["sh", "-c", "cat >/dev/null; exit 3"]):
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                noby.stream_export(producer, str(output), "gz")
+            self.assertEqual((cm.exception.returncode, cm.exception.cmd[0]), (3, "sh"))
+
+    def test_export_cache(self):
+        (self.runtime / "aaa").mkdir()
+        r = noby.ImageStorage(self.runtime)
+        r.add_image("aaa", {"parent_hash": ""})
+        r.tag("img", "aaa")
+        args = argparse.Namespace(runtime=str(self.runtime), container="img", type="squashfs",
+                                  output=str(self.runtime / "out.squashfs"), incremental=False,
+                                  threads=0, comp="zstd", block_size="1M", no_cache=False)
+
+        def mksquashfs(cmd, **kwargs):
+            self.assertEqual(cmd[3:], ["-no-xattrs", "-noappend", "-comp", "zstd", "-b", "1048576"])
+            Path(cmd[2]).write_bytes(b"squashfs")
+        with mock.patch("subprocess.run", side_effect=mksquashfs) as run, \
+                contextlib.redirect_stdout(io.StringIO()):
+            noby.export(args)
+            noby.export(args)
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual((self.runtime / "out.squashfs").read_bytes(), b"squashfs")
+
+        r.remove_image("aaa")
+        self.assertEqual(list((self.runtime / noby.export_cache_name).iterdir()), [])
+
+    def test_tag(self):
+        (self.runtime / "aaa").mkdir()
+        r = noby.ImageStorage(self.runtime)
+        r.add_image("aaa", {"parent_hash": ""})
+        r.tag("busybox", "aaa")
+        self.assertEqual(r.find_last_build_by_name("busybox"), "aaa")
+        self.assertIn("tag-busybox", r.images)
+
+        r.reindex()
+        self.assertIn("tag-busybox", r.images)
+        r.untag("busybox")
+        self.assertIsNone(r.find_last_build_by_name("busybox"))
+
+    def test_remove_tagged_image(self):
+        (self.runtime / "aaa").mkdir()
+        r = noby.ImageStorage(self.runtime)
+        r.add_image("aaa", {"parent_hash": ""})
+        r.tag("t", "aaa")
+        r.remove_image("aaa")
+        self.assertEqual(r.tags(), {})
+        self.assertFalse(r.db.in_transaction)
+        self.assertEqual(noby.ImageStorage(self.runtime).tags(), {})
+
+    def test_gc_plan(self):
+        r = noby.ImageStorage(self.runtime)
+        for name, parent, used in (("base", "", 10), ("tagged", "base", 20),
+                                   ("old", "base", 1), ("older", "old", 0), ("new", "base", 100)):
+            (self.runtime / name).mkdir()
+            r.add_image(name, {"parent_hash": parent})
+            r.db.execute("UPDATE images SET last_used = ? WHERE name = ?", (used, name))
+        r.db.commit()
+        r.tag("keep", "tagged")
+        self.assertEqual(r.reachable(), {"tagged", "base"})
+
+        evict, freed = noby.gc_plan(r, max_age=50, now=101)
+        self.assertEqual(evict, ["older", "old"])
+        evict, freed = noby.gc_plan(r, max_age=0, now=101)
+        self.assertEqual(evict, ["older", "old", "new"])
+
+        for name in ("older", "new"):
+            (self.runtime / name / "data").write_bytes(b"x" * 1024 * 1024)
+        r.db.execute("DELETE FROM image_sizes")  # sealed images never change outside tests
+        evict, freed = noby.gc_plan(r, max_size=r.image_size("base") + 1024 * 1024 + 4096)
+        self.assertEqual(evict, ["older"])
+        self.assertGreaterEqual(freed, 1024 * 1024)
+
+    def test_gc_skips_locked_images(self):
+        r = noby.ImageStorage(self.runtime)
+        for name, parent in (("base", ""), ("busy", "base"), ("idle", "")):
+            (self.runtime / name).mkdir()
+            r.add_image(name, {"parent_hash": parent})
+        lock = noby.StepLock(self.runtime, "busy")
+        lock.acquire(shared=True)
+        self.addCleanup(lock.release)
+        args = argparse.Namespace(runtime=str(self.runtime), max_size=None, max_age=None, batch=10, dry_run=False)
+        with FakeBackend().installed(), \
+                contextlib.redirect_stdout(io.StringIO()):
+            noby.gc(args)
+        self.assertEqual(sorted(r.parents()), ["base", "busy"])
+        self.assertEqual(os.listdir(str(self.runtime / ".locks")), ["busy.lock"])
+
+    def test_find_image_by_attr(self):
+        r = noby.ImageStorage(self.runtime)
+        r.add_image("imported-image-a", {"import_digest": "abc"})
+        self.assertEqual(r.find_image_by_attr("import_digest", "abc"), "imported-image-a")
+        self.assertIsNone(r.find_image_by_attr("import_digest", "def"))
+
+    def test_import_type(self):
+        self.assertEqual(noby.import_type("busybox.tar.zst"), (".tar.zst", "tar.zst"))
+        self.assertEqual(noby.import_type("busybox.sqsh"), (".sqsh", "squashfs"))
+        self.assertEqual(noby.import_type("busybox.zip"), (".zip", None))
+
+    def test_parse_units(self):
+        self.assertEqual(noby.parse_size("2G"), 2 * 1024 ** 3)
+        self.assertEqual(noby.parse_size("512MiB"), 512 * 1024 ** 2)
+        self.assertEqual(noby.parse_duration("7d"), 7 * 86400)
+
+
+if __name__ == '__main__':
+    unittest.main()
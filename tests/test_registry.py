@@ -0,0 +1,36 @@
+import unittest
+import tempfile
+from pathlib import Path
+import noby
+
+
+class DirectoryRegistryTestCase(unittest.TestCase):
+    def test_layers_and_tags(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            registry = noby.DirectoryRegistry(Path(tmp) / "registry")
+            registry.put_layer("base", {"parent_hash": "", "subvolume": "base", "attrs": {}}, ("echo", "base"))
+            registry.put_layer("top", {"parent_hash": "base", "subvolume": "top", "attrs": {}}, ("echo", "top"))
+            registry.set_tag("busybox", "top")
+
+            self.assertTrue(registry.has_layer("top"))
+            self.assertFalse(registry.has_layer("other"))
+            self.assertEqual(registry.layer_stream("base").read_text(), "base\n")
+            self.assertEqual(registry.get_tag("busybox"), "top")
+            self.assertEqual(registry.chain("top"), ["base", "top"])
+            with self.assertRaises(FileNotFoundError):
+                registry.get_tag("missing")
+
+    def test_full_stream_fallback(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            registry = noby.DirectoryRegistry(Path(tmp) / "registry")
+            registry.put_layer("base", {"parent_hash": "", "subvolume": "base", "attrs": {}}, ("echo", "base"))
+            registry.put_layer("top", {"parent_hash": "base", "parent_uuid": "sent-uuid", "subvolume": "top", "attrs": {}},
+                               ("echo", "incremental"), ("echo", "full"))
+
+            self.assertEqual(registry.receive_stream("base", ()), registry.layer_stream("base"))
+            self.assertEqual(registry.receive_stream("top", ("local-uuid", "sent-uuid")).read_text(), "incremental\n")
+            self.assertEqual(registry.receive_stream("top", ("local-uuid", None)).read_text(), "full\n")
+
+
+if __name__ == '__main__':
+    unittest.main()